@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # ANN search is optional; without hnswlib every search stays exact
+    hnswlib = None
+
+# Approximate nearest neighbour indexes for large sessions and long-term memories.
+# Keys below ANN_THRESHOLD vectors keep using the exact matrix search. Above it an
+# HNSW index is built once, extended as new texts are inserted and saved under
+# ANN_INDEX_DIR so it survives restarts. Index entries carry the caller's ids
+# (message indices or document ids); a count check against the database catches
+# up on rows written by other workers, or rebuilds the index if it cannot. Callers
+# only need that count for keys that have an index or were last seen near the
+# threshold (should_count), so small keys are searched without it.
+ANN_THRESHOLD = int(os.getenv("ANN_THRESHOLD", 5000))
+ANN_INDEX_DIR = os.getenv("ANN_INDEX_DIR", "ann_indexes")
+ANN_MAX_LOADED = int(os.getenv("ANN_MAX_LOADED", 64))
+ANN_SAVE_EVERY = int(os.getenv("ANN_SAVE_EVERY", 100))
+ANN_EF_SEARCH = int(os.getenv("ANN_EF_SEARCH", 100))
+# Keys last seen above this fraction of the threshold are counted on every search
+ANN_COUNT_MARGIN = 0.9
+# Index files no longer named by their ids file are removed after this many seconds,
+# leaving time for a reader that loaded the ids just before they were replaced
+ANN_STALE_FILE_AGE = 60
+
+
+class HnswIndex:
+    def __init__(self, dim, capacity=1024, ids=None, index=None):
+        self.dim = dim
+        self.ids = ids or []
+        self._positions = {doc_id: label for label, doc_id in enumerate(self.ids)}
+        self.unsaved = 0
+        self.lock = threading.Lock()
+        if index is None:
+            index = hnswlib.Index(space='cosine', dim=dim)
+            index.init_index(max_elements=capacity, ef_construction=200, M=16)
+        self.index = index
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    @property
+    def last_id(self):
+        return self.ids[-1] if self.ids else None
+
+    # Add vectors under the given ids, skipping ids that are already indexed
+    def add(self, ids, vectors):
+        with self.lock:
+            new = [(doc_id, vector) for doc_id, vector in zip(ids, vectors) if doc_id not in self._positions]
+            if not new:
+                return
+            capacity = self.index.get_max_elements()
+            if self.count + len(new) > capacity:
+                self.index.resize_index(max(capacity * 2, self.count + len(new)))
+            labels = np.arange(self.count, self.count + len(new))
+            self.index.add_items(np.asarray([vector for _, vector in new], dtype=np.float32), labels)
+            for label, (doc_id, _) in zip(labels, new):
+                self._positions[doc_id] = int(label)
+                self.ids.append(doc_id)
+            self.unsaved += len(new)
+
+    # Ids and cosine scores of the k nearest vectors, best first
+    def query(self, query_embedding, k):
+        with self.lock:
+            k = min(k, self.count)
+            if k == 0:
+                return [], []
+            self.index.set_ef(max(ANN_EF_SEARCH, k))
+            labels, distances = self.index.knn_query(np.asarray(query_embedding, dtype=np.float32), k=k)
+        return [self.ids[label] for label in labels[0]], (1 - distances[0]).astype(float).tolist()
+
+    # Write the index under a new file name, then replace the ids file that names it. The
+    # ids file is the single commit point, so readers always get a matching pair even
+    # when several worker processes save the same key.
+    def save(self, path):
+        directory, base = os.path.split(path)
+        with self.lock:
+            index_file = f"{base}.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+            self.index.save_index(os.path.join(directory, index_file))
+            tmp = f"{path}.ids.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'dim': self.dim, 'ids': self.ids, 'index': index_file}, f)
+            os.replace(tmp, path + '.ids')
+            self.unsaved = 0
+        _remove_stale_files(directory, base, index_file)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path + '.ids') as f:
+                meta = json.load(f)
+            index = hnswlib.Index(space='cosine', dim=meta['dim'])
+            index.load_index(os.path.join(os.path.dirname(path), meta['index']), max_elements=max(1024, len(meta['ids'])))
+        except (OSError, ValueError, RuntimeError, KeyError):
+            # Missing, incomplete, or replaced by another process while being read
+            return None
+        if index.get_current_count() != len(meta['ids']):
+            return None
+        return cls(meta['dim'], ids=meta['ids'], index=index)
+
+
+# Remove index files of the key other than the current one once they are old enough
+def _remove_stale_files(directory, base, current):
+    cutoff = time.time() - ANN_STALE_FILE_AGE
+    for name in os.listdir(directory):
+        if not name.startswith(base) or name in (current, base + '.ids'):
+            continue
+        full = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(full) < cutoff:
+                os.remove(full)
+        except OSError:
+            pass
+
+
+class AnnIndexManager:
+    def __init__(self, name, directory=ANN_INDEX_DIR, threshold=ANN_THRESHOLD, max_loaded=ANN_MAX_LOADED):
+        self.name = name
+        self.directory = directory
+        self.threshold = threshold
+        self.max_loaded = max_loaded
+        self._indexes = OrderedDict()
+        # Last vector count seen per key, bounded like the loaded indexes
+        self._sizes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return hnswlib is not None
+
+    def _path(self, key):
+        digest = hashlib.sha1(str(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, self.name, digest + '.bin')
+
+    # Index for the key from memory or disk, or None if it was never built
+    def _get(self, key):
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        index = HnswIndex.load(self._path(key))
+        if index is not None:
+            self._put(key, index)
+        return index
+
+    def _put(self, key, index):
+        with self._lock:
+            self._indexes[key] = index
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > self.max_loaded:
+                evicted_key, evicted = self._indexes.popitem(last=False)
+                if evicted.unsaved:
+                    self._save(evicted_key, evicted)
+
+    def _save(self, key, index):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index.save(path)
+
+    def _build(self, key, ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        index = HnswIndex(vectors.shape[1], capacity=max(1024, 2 * len(ids)))
+        index.add(ids, vectors)
+        self._save(key, index)
+        self._put(key, index)
+        return index
+
+    # Write every loaded index with unsaved vectors to disk, e.g. before the process exits
+    def save_all(self):
+        with self._lock:
+            indexes = list(self._indexes.items())
+        for key, index in indexes:
+            if index.unsaved:
+                self._save(key, index)
+
+    # Record how many vectors the key holds, as seen by a search
+    def observe(self, key, count):
+        with self._lock:
+            self._sizes[key] = count
+            self._sizes.move_to_end(key)
+            while len(self._sizes) > self.max_loaded * 100:
+                self._sizes.popitem(last=False)
+
+    # Whether a search for the key should count its vectors and call search(): true for
+    # keys with an index, and for keys last seen near the threshold, which may cross it
+    def should_count(self, key):
+        if not self.enabled:
+            return False
+        with self._lock:
+            if key in self._indexes:
+                return True
+            size = self._sizes.get(key)
+        if size is not None and size >= self.threshold * ANN_COUNT_MARGIN:
+            return True
+        return os.path.exists(self._path(key) + '.ids')
+
+    # Extend an existing index with newly inserted vectors; small keys are left to exact search
+    def add(self, key, ids, vectors):
+        if not self.enabled:
+            return
+        index = self._get(key)
+        if index is None:
+            return
+        index.add(ids, vectors)
+        if index.unsaved >= ANN_SAVE_EVERY:
+            self._save(key, index)
+
+    # Approximate (ids, scores) for the key, or None when exact search should be used.
+    # count is the number of distinct ids the caller's data holds for the key.
+    # fetch_after(last_id) returns the (ids, vectors) written after the last indexed id
+    # and fetch_all() returns every (ids, vectors) pair for a rebuild. An index that is
+    # ahead of the caller (rows added after the caller read its data) is still used;
+    # known(ids), when given, returns a mask of the ids the caller holds and the
+    # results are limited to those.
+    def search(self, key, query_embedding, k, count, fetch_after, fetch_all, known=None):
+        self.observe(key, count)
+        if not self.enabled or count < self.threshold:
+            return None
+        index = self._get(key)
+        if index is not None and index.count < count:
+            index.add(*fetch_after(index.last_id))
+        if index is None or index.count < count:
+            index = self._build(key, *fetch_all())
+        extra = index.count - count
+        if extra == 0 or known is None:
+            return index.query(query_embedding, k)
+        ids, scores = index.query(query_embedding, k + extra)
+        mask = known(ids)
+        kept = [(doc_id, score) for doc_id, score, keep in zip(ids, scores, mask) if keep][:k]
+        return [doc_id for doc_id, _ in kept], [score for _, score in kept]
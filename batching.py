@@ -0,0 +1,38 @@
+import queue
+import threading
+import time
+
+# Helpers shared by the background batchers (ltm_queue, embedding_coalescer).
+
+
+# A daemon thread that is started on first use rather than at import, so no
+# thread exists yet in a process that forks later (gunicorn workers), and that
+# is restarted if it has died
+class LazyThread:
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+                self._thread.start()
+
+
+# Block for the first item of a queue, then take more until max_size items are
+# collected or max_wait seconds have passed since the first one arrived
+def next_batch(pending, max_size, max_wait):
+    batch = [pending.get()]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < max_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(pending.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
@@ -0,0 +1,180 @@
+# Load test for the session-rag service.
+#
+# Usage:
+#   python bench_load.py                                   (in-process app, mongomock, local embeddings)
+#   python bench_load.py --mongo-uri mongodb://localhost:27017/ --sizes 1000 10000
+#   python bench_load.py --url http://localhost:8888       (a running server, seeded over HTTP)
+#
+# For each session size one session and one long-term memory user are seeded with
+# that many texts through the bulk endpoints. /add_text, /search,
+# /search_long_term_memory and /resolve_references are then driven at the given
+# concurrency, and p50/p95/p99 latency and throughput are reported per endpoint and
+# size. In-process runs use the local hashing embedding backend
+# (EMBEDDING_PROVIDER=local), so no API calls are made. Add latency with
+# LOCAL_EMBEDDING_LATENCY_MS to model the real API.
+#
+# mongomock is single-process and unindexed, so its numbers show the app's own cost.
+# Use --mongo-uri against a local mongod for realistic database timings.
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_reference_matcher import FILLER, PROBES
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "longterm-session-relative-fuzzy.py")
+ENDPOINTS = ['/add_text', '/search', '/search_long_term_memory', '/resolve_references']
+
+
+# Import the Flask app with offline backends; the database is mongomock unless a URI is given
+def load_app(app_path, mongo_uri=None):
+    os.environ.setdefault("EMBEDDING_PROVIDER", "local")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("ANN_INDEX_DIR", tempfile.mkdtemp(prefix='bench_ann_'))
+    if mongo_uri:
+        os.environ["MONGO_URI"] = mongo_uri
+    else:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        os.environ["MONGO_ENSURE_INDEXES"] = "0"
+    spec = importlib.util.spec_from_file_location('bench_app', app_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, payload):
+        return self.client.post(path, json=payload).status_code
+
+
+class HttpClient:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def post(self, path, payload):
+        request = urllib.request.Request(
+            self.url + path, data=json.dumps(payload).encode('utf-8'), headers={'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(FILLER) for _ in range(words))
+
+
+def seed(client, session_id, uuid, size, rng, chunk=500):
+    for start in range(0, size, chunk):
+        texts = [sentence(rng) for _ in range(min(chunk, size - start))]
+        assert client.post('/add_texts', {'session_id': session_id, 'texts': texts}) < 400
+        assert client.post('/add_texts_to_long_term_memory', {'uuid': uuid, 'texts': texts, 'gate': False}) < 400
+
+
+# Request payload for an endpoint; queries come from a small pool so some repeat, as in production
+def payload(endpoint, session_id, uuid, scratch_session_id, queries, rng):
+    if endpoint == '/add_text':
+        return {'session_id': scratch_session_id, 'text': sentence(rng)}
+    if endpoint == '/search':
+        return {'session_id': session_id, 'query': rng.choice(queries), 'top_n': 10}
+    if endpoint == '/search_long_term_memory':
+        return {'uuid': uuid, 'query': rng.choice(queries), 'top_n': 10}
+    return {'session_id': session_id, 'text': rng.choice(PROBES)}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+# Drive one endpoint with requests spread over the given number of threads
+def drive(make_client, endpoint, payloads, concurrency):
+    local = threading.local()
+
+    def call(body):
+        if not hasattr(local, 'client'):
+            local.client = make_client()
+        start = time.perf_counter()
+        status = local.client.post(endpoint, body)
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, payloads))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    return {
+        'requests': len(results),
+        'errors': sum(1 for _, status in results if status >= 400),
+        'throughput': len(results) / elapsed,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the session-rag endpoints')
+    parser.add_argument('--url', help='Base URL of a running server; the app is run in-process otherwise')
+    parser.add_argument('--app', default=APP_PATH, help='App module for in-process runs')
+    parser.add_argument('--mongo-uri', help='MongoDB for in-process runs; mongomock is used otherwise')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint and size')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=50, help='Distinct queries in the pool')
+    parser.add_argument('--endpoints', nargs='+', default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        app = load_app(args.app, args.mongo_uri)
+        make_client = lambda: InProcessClient(app)
+
+    rng = random.Random(args.seed)
+    run_id = f"{int(time.time())}-{rng.randrange(1 << 30)}"
+    queries = [sentence(rng, 8) for _ in range(args.queries)]
+    results = []
+
+    print(f"{'endpoint':<26} {'size':>7} {'reqs':>6} {'errors':>6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for size in args.sizes:
+        session_id = f"bench-{run_id}-session-{size}"
+        uuid = f"bench-{run_id}-user-{size}"
+        scratch_session_id = f"bench-{run_id}-scratch-{size}"
+        seed(make_client(), session_id, uuid, size, rng)
+
+        for endpoint in args.endpoints:
+            warmup = [payload(endpoint, session_id, uuid, scratch_session_id, queries, rng) for _ in range(args.warmup)]
+            drive(make_client, endpoint, warmup, args.concurrency)
+            payloads = [payload(endpoint, session_id, uuid, scratch_session_id, queries, rng) for _ in range(args.requests)]
+            row = {'endpoint': endpoint, 'size': size, **drive(make_client, endpoint, payloads, args.concurrency)}
+            results.append(row)
+            print(
+                f"{endpoint:<26} {size:>7} {row['requests']:>6} {row['errors']:>6} {row['throughput']:>9.1f} "
+                f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}"
+            )
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'concurrency': args.concurrency, 'results': results}, f, indent=2)
@@ -0,0 +1,99 @@
+# Micro-benchmarks for the hot steps of the search path.
+#
+# Usage: python bench_micro.py [--sizes 100 1000 10000] [--repeat 20] [--json out.json]
+#
+#   scoring    scipy cosine per row (the original apps) vs one matrix-vector product
+#   decode     BSON decode of a stored embedding: array of doubles, float32 and float16 blobs
+#   references reference matching: the per-request thefuzz loop vs the compiled matcher
+#
+# Vectors are synthetic and no network or database is used. The scoring and decode
+# results are checked against each other before the timings are reported.
+
+import argparse
+import json
+import time
+
+import bson
+import numpy as np
+
+from bench_reference_matcher import PROBES, make_messages
+from embedding_codec import decode_embedding, encode_embedding
+from reference_matcher import ReferenceMatcher, load_patterns, resolve_with_loop
+from scoring import cosine_scores, stack_embeddings
+
+DIM = 1536
+
+
+def time_per_call(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1e6 / repeat
+
+
+def bench_scoring(sizes, repeat):
+    from scipy import spatial
+    rng = np.random.default_rng(0)
+    query = rng.standard_normal(DIM).tolist()
+    rows = []
+    for size in sizes:
+        embeddings = [row.tolist() for row in rng.standard_normal((size, DIM))]
+        matrix = stack_embeddings(embeddings)
+        per_row = lambda: [1 - spatial.distance.cosine(query, embedding) for embedding in embeddings]
+        vectorized = lambda: cosine_scores(matrix, query)
+        assert np.allclose(per_row(), vectorized(), atol=1e-4)
+        # The per-row loop gets fewer repeats on large sizes to keep the run short
+        per_row_us = time_per_call(per_row, max(1, repeat * 100 // size))
+        matrix_us = time_per_call(vectorized, repeat)
+        rows.append({'size': size, 'per_row_us': per_row_us, 'matrix_us': matrix_us})
+        print(f"scoring    {size:>7} rows  per-row {per_row_us:>12.1f} us  matrix {matrix_us:>10.1f} us  {per_row_us / matrix_us:>7.1f}x")
+    return rows
+
+
+def bench_decode(repeat):
+    embedding = np.random.default_rng(1).standard_normal(DIM).tolist()
+    rows = []
+    for storage in ('list', 'float32', 'float16'):
+        payload = bson.encode({'embedding': encode_embedding(embedding, storage)})
+        decode = lambda: decode_embedding(bson.decode(payload)['embedding'])
+        assert np.allclose(decode(), embedding, atol=1e-2)
+        decode_us = time_per_call(decode, repeat * 100)
+        rows.append({'storage': storage, 'bytes': len(payload), 'decode_us': decode_us})
+        print(f"decode     {storage:>7}  {len(payload):>6} bytes  {decode_us:>8.1f} us per document")
+    return rows
+
+
+def bench_references(repeat):
+    _, patterns = load_patterns()
+    matcher = ReferenceMatcher(patterns)
+    rows = []
+    for length in (5, 50, 200):
+        messages = make_messages(length, len(PROBES) * 2)
+        for message in messages:
+            assert matcher.resolve(message) == resolve_with_loop(message, patterns), message
+        loop_us = time_per_call(lambda: [resolve_with_loop(message, patterns) for message in messages], repeat) / len(messages)
+        matcher_us = time_per_call(lambda: [matcher.resolve(message) for message in messages], repeat) / len(messages)
+        rows.append({'words': length, 'loop_us': loop_us, 'matcher_us': matcher_us})
+        print(f"references {length:>7} words loop {loop_us:>10.1f} us  matcher {matcher_us:>10.1f} us  {loop_us / matcher_us:>7.1f}x")
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for scoring, decoding and reference matching')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', choices=['scoring', 'decode', 'references'])
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    if args.only in (None, 'scoring'):
+        results['scoring'] = bench_scoring(args.sizes, args.repeat)
+    if args.only in (None, 'decode'):
+        results['decode'] = bench_decode(args.repeat)
+    if args.only in (None, 'references'):
+        results['references'] = bench_references(args.repeat)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
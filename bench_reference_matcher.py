@@ -0,0 +1,68 @@
+# Benchmark of the compiled reference matcher against the old per-request loop.
+#
+# Usage: python bench_reference_matcher.py [--repeat 200]
+#
+# Messages of increasing length are resolved by both implementations; every
+# result is checked for equality before timings are reported.
+
+import argparse
+import random
+import time
+
+from reference_matcher import ReferenceMatcher, load_patterns, resolve_with_loop
+
+FILLER = (
+    "we went over the quarterly numbers and the migration plan for the new cluster "
+    "then talked about hiring for the platform team and the budget for next year "
+).split()
+
+PROBES = [
+    "Tell me more about it",
+    "Which one is better?",
+    "What was my last message?",
+    "could you elaborat on the second option",
+    "remnd me abot the deadline",
+    "ok thanks",
+]
+
+
+def make_messages(length, count, seed=0):
+    rng = random.Random(seed)
+    messages = []
+    for n in range(count):
+        words = [rng.choice(FILLER) for _ in range(length)]
+        words.insert(rng.randrange(len(words) + 1), PROBES[n % len(PROBES)])
+        messages.append(' '.join(words))
+    return messages
+
+
+def time_per_call(fn, messages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            fn(message)
+    return (time.perf_counter() - start) * 1e6 / (repeat * len(messages))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark reference resolution')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--lengths', type=int, nargs='+', default=[5, 50, 200, 1000])
+    args = parser.parse_args()
+
+    version, patterns = load_patterns()
+    loop = lambda message: resolve_with_loop(message, patterns)
+    start = time.perf_counter()
+    matcher = ReferenceMatcher(patterns)
+    print(f"Compiled {len(matcher.keywords)} keywords from patterns version {version} in {(time.perf_counter() - start) * 1000:.2f} ms")
+    print(f"{'words':>6} {'loop us':>10} {'matcher us':>11} {'speedup':>8}")
+
+    for length in args.lengths:
+        messages = make_messages(length, len(PROBES) * 2)
+        for message in messages + PROBES:
+            expected = loop(message)
+            actual = matcher.resolve(message)
+            assert actual == expected, (message, expected, actual)
+        loop_us = time_per_call(loop, messages, args.repeat)
+        matcher_us = time_per_call(matcher.resolve, messages, args.repeat)
+        print(f"{length:>6} {loop_us:>10.1f} {matcher_us:>11.1f} {loop_us / matcher_us:>7.1f}x")
@@ -0,0 +1,90 @@
+# Throughput of the gunicorn deployment by worker count.
+#
+# Usage: MONGO_URI=mongodb://localhost:27017/ python bench_workers.py [--workers 1 2 4 8] [--threads 8]
+#
+# For each worker count a server is started with gunicorn -c gunicorn.conf.py wsgi:app
+# and driven over HTTP by the bench_load.py client, and requests per second and
+# p50/p99 latency are reported per endpoint. The servers use the local embedding
+# backend (EMBEDDING_PROVIDER=local) unless the environment says otherwise, and need
+# a MongoDB reachable by every worker.
+
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from bench_load import ENDPOINTS, HttpClient, drive, payload, seed, sentence
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start within {timeout}s")
+
+
+def start_server(workers, threads, port):
+    env = dict(os.environ)
+    env.setdefault("EMBEDDING_PROVIDER", "local")
+    env.setdefault("OPENAI_API_KEY", "bench")
+    env.update({'WEB_WORKERS': str(workers), 'WEB_THREADS': str(threads), 'PORT': str(port), 'HOST': '127.0.0.1'})
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Requests per second by gunicorn worker count')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--size', type=int, default=1000, help='Texts in the searched session and memory')
+    parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint and worker count')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--endpoints', nargs='+', default=['/search', '/search_long_term_memory'], choices=ENDPOINTS)
+    args = parser.parse_args()
+
+    if not os.getenv("MONGO_URI"):
+        parser.error("MONGO_URI must point at a MongoDB shared by all workers")
+
+    rng = random.Random(0)
+    run_id = f"{int(time.time())}-{rng.randrange(1 << 30)}"
+    queries = [sentence(rng, 8) for _ in range(50)]
+    session_id = f"bench-{run_id}-session"
+    uuid = f"bench-{run_id}-user"
+    scratch_session_id = f"bench-{run_id}-scratch"
+    make_client = lambda: HttpClient(f"http://127.0.0.1:{args.port}")
+
+    print(f"{'workers':>7} {'endpoint':<26} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>6}")
+    baseline = {}
+    for n, workers in enumerate(args.workers):
+        server = start_server(workers, args.threads, args.port)
+        try:
+            wait_for_port(args.port)
+            if n == 0:
+                seed(make_client(), session_id, uuid, args.size, rng)
+            for endpoint in args.endpoints:
+                # Warm every worker's caches before measuring
+                drive(make_client, endpoint, [payload(endpoint, session_id, uuid, scratch_session_id, queries, rng)
+                                              for _ in range(workers * args.threads * 2)], args.concurrency)
+                payloads = [payload(endpoint, session_id, uuid, scratch_session_id, queries, rng) for _ in range(args.requests)]
+                row = drive(make_client, endpoint, payloads, args.concurrency)
+                baseline.setdefault(endpoint, row['throughput'])
+                print(
+                    f"{workers:>7} {endpoint:<26} {row['throughput']:>9.1f} {row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} "
+                    f"{row['errors']:>6}  {row['throughput'] / baseline[endpoint]:.2f}x"
+                )
+        finally:
+            # SIGTERM is gunicorn's graceful shutdown
+            server.terminate()
+            server.wait(timeout=60)
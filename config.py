@@ -0,0 +1,27 @@
+import os
+
+# Server settings, read from the environment, shared by the apps' development
+# server (python <app>.py), wsgi.py and gunicorn.conf.py.
+
+# App served by wsgi.py, as a file path relative to this directory
+APP_MODULE = os.getenv("APP_MODULE", "longterm-session-relative-fuzzy.py")
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 8888))
+# Flask debugger and reloader for the development server only
+DEBUG = os.getenv("FLASK_DEBUG", "0") == "1"
+
+# gunicorn: worker processes, threads per worker and timeouts in seconds
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", os.cpu_count() or 1))
+WEB_THREADS = int(os.getenv("WEB_THREADS", 8))
+WEB_TIMEOUT = int(os.getenv("WEB_TIMEOUT", 120))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", 30))
+WEB_KEEPALIVE = int(os.getenv("WEB_KEEPALIVE", 5))
+WEB_BACKLOG = int(os.getenv("WEB_BACKLOG", 2048))
+# Recycle a worker after this many requests (0 never), jittered so workers do not restart together
+WEB_MAX_REQUESTS = int(os.getenv("WEB_MAX_REQUESTS", 0))
+WEB_MAX_REQUESTS_JITTER = int(os.getenv("WEB_MAX_REQUESTS_JITTER", 0))
+WEB_LOG_LEVEL = os.getenv("WEB_LOG_LEVEL", "info")
+
+# Time an exiting worker spends finishing background work (queued long-term memories)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 20))
@@ -0,0 +1,174 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+# Content-addressed cache in front of the embeddings API.
+# Keys are a hash of the model name and the normalized text, so repeated
+# queries and texts that were already embedded elsewhere skip the API call.
+# Lookups go through an in-process LRU tier first and then an optional
+# persistent tier (a Mongo collection or a local SQLite file).
+# Embeddings are held and returned as compact float32 arrays (array('f')), about
+# 6 KB for 1536 dimensions instead of about 50 KB as a list of Python floats, and
+# the in-process tier is bounded by bytes as well as by entries.
+
+
+def compact(embedding):
+    if isinstance(embedding, array) and embedding.typecode == 'f':
+        return embedding
+    return array('f', embedding)
+
+
+# Normalize unicode form and collapse whitespace before hashing
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+
+# Persistent tier backed by a MongoDB collection, keyed by _id
+class MongoEmbeddingStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get_many(self, keys):
+        from embedding_codec import decode_embedding
+        cursor = self.collection.find({'_id': {'$in': list(keys)}}, {'embedding': 1})
+        return {doc['_id']: compact(decode_embedding(doc['embedding'])) for doc in cursor}
+
+    def put_many(self, items, model):
+        from pymongo import UpdateOne
+        from embedding_codec import encode_embedding
+        operations = [
+            UpdateOne({'_id': key}, {'$setOnInsert': {'model': model, 'embedding': encode_embedding(embedding)}}, upsert=True)
+            for key, embedding in items.items()
+        ]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+
+# Persistent tier backed by a local SQLite file, embeddings stored as packed doubles
+class DiskEmbeddingStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, embedding BLOB)')
+        self._conn.commit()
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        placeholders = ','.join('?' * len(keys))
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})', keys
+            ).fetchall()
+        return {key: compact(array('d', blob)) for key, blob in rows}
+
+    def put_many(self, items, model):
+        rows = [(key, model, array('d', embedding).tobytes()) for key, embedding in items.items()]
+        with self._lock:
+            self._conn.executemany('INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?)', rows)
+            self._conn.commit()
+
+
+class EmbeddingCache:
+    def __init__(self, model, max_entries=10000, store=None, max_bytes=64 * 1024 * 1024):
+        self.model = model
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.store = store
+        self._memory = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def _remember(self, key, embedding):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._bytes -= old.itemsize * len(old)
+        self._memory[key] = embedding
+        self._bytes += embedding.itemsize * len(embedding)
+        while self._memory and (len(self._memory) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._memory.popitem(last=False)
+            self._bytes -= evicted.itemsize * len(evicted)
+
+    # Embedding for one text, calling create_fn(text) only on a miss in both tiers
+    def get_or_create(self, text, create_fn):
+        return self.get_or_create_many([text], lambda texts: [create_fn(texts[0])])[0]
+
+    # Embeddings for a list of texts; create_many_fn(texts) is called once with the misses
+    def get_or_create_many(self, texts, create_many_fn):
+        keys = [cache_key(self.model, text) for text in texts]
+        found = {}
+
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            self.memory_hits += sum(1 for key in keys if key in found)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing and self.store is not None:
+            stored = self.store.get_many(missing)
+            found.update(stored)
+            with self._lock:
+                self.store_hits += sum(1 for key in keys if key in stored)
+                for key, embedding in stored.items():
+                    self._remember(key, embedding)
+            missing = [key for key in missing if key not in stored]
+
+        if missing:
+            # Embed the first text seen for each missing key
+            texts_by_key = {}
+            for key, text in zip(keys, texts):
+                texts_by_key.setdefault(key, text)
+            created = dict(zip(missing, map(compact, create_many_fn([texts_by_key[key] for key in missing]))))
+            found.update(created)
+            with self._lock:
+                self.misses += sum(1 for key in keys if key in created)
+                for key, embedding in created.items():
+                    self._remember(key, embedding)
+            if self.store is not None:
+                self.store.put_many(created, self.model)
+
+        return [found[key] for key in keys]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.store_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'hit_rate': (lookups - self.misses) / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._bytes,
+            }
+
+
+# Build the cache configured by EMBEDDING_CACHE_BACKEND (mongo, disk, memory or none).
+# The default is the given Mongo collection when there is one, otherwise a local file.
+def make_embedding_cache(model, collection=None):
+    backend = os.getenv("EMBEDDING_CACHE_BACKEND", "mongo" if collection is not None else "disk")
+    max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 10000))
+    max_bytes = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+    if backend == "none":
+        return EmbeddingCache(model, max_entries=0)
+    if backend == "mongo" and collection is not None:
+        return EmbeddingCache(model, max_entries, MongoEmbeddingStore(collection), max_bytes)
+    if backend == "disk":
+        path = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+        return EmbeddingCache(model, max_entries, DiskEmbeddingStore(path), max_bytes)
+    return EmbeddingCache(model, max_entries, max_bytes=max_bytes)
@@ -0,0 +1,111 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from batching import LazyThread, next_batch
+from embedding_cache import cache_key
+
+# Request coalescing in front of the embedding backend.
+# The embedding cache only serves completed results, so concurrent misses for the
+# same text would each call the API. Here the first caller for a (model, text) key
+# makes the call and later callers wait on the same future (single-flight).
+# With a batching window, distinct texts that arrive within the window are sent
+# together in one list call (micro-batching). One thread collects the batches and
+# a pool sends them, so a slow or retried call holds up only its own batch.
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5))
+EMBEDDING_BATCH_MAX = int(os.getenv("EMBEDDING_BATCH_MAX", 64))
+# Batches that may be in flight at once
+EMBEDDING_BATCH_CONCURRENCY = int(os.getenv("EMBEDDING_BATCH_CONCURRENCY", 8))
+
+
+class EmbeddingCoalescer:
+    # embed_fn(text) embeds one text; embed_many_fn(texts) embeds a list in order.
+    # A window of 0 turns micro-batching off and keeps only single-flight.
+    # A batch failing with one of split_errors (errors caused by a single input, such
+    # as a rejected text) is retried text by text so the other texts still succeed;
+    # any other error fails every text of the batch.
+    def __init__(self, model, embed_fn, embed_many_fn, window_ms=EMBEDDING_BATCH_WINDOW_MS, max_batch=EMBEDDING_BATCH_MAX,
+                 concurrency=EMBEDDING_BATCH_CONCURRENCY, split_errors=()):
+        self.model = model
+        self.embed_fn = embed_fn
+        self.embed_many_fn = embed_many_fn
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.split_errors = split_errors
+        self._inflight = {}
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        self._collector = LazyThread(self._run, 'embedding-batcher')
+        # Its own pool: callers may already be running on the app's I/O threads
+        self._senders = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='embedding-batch')
+        self.counts = {'requests': 0, 'coalesced': 0, 'batches': 0, 'batched_texts': 0, 'split_batches': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    # Embedding of the text, shared with any concurrent caller asking for the same text
+    def embed(self, text):
+        key = cache_key(self.model, text)
+        with self._lock:
+            self.counts['requests'] += 1
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.counts['coalesced'] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            embedding = self._batched(text) if self.window > 0 else self.embed_fn(text)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(embedding)
+            return embedding
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _batched(self, text):
+        future = Future()
+        self._collector.ensure_started()
+        self._pending.put((text, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            self._senders.submit(self._send, next_batch(self._pending, self.max_batch, self.window))
+
+    def _send(self, batch):
+        try:
+            embeddings = self.embed_many_fn([text for text, _ in batch])
+        except Exception as e:
+            if len(batch) > 1 and isinstance(e, self.split_errors):
+                self._count('split_batches')
+                for text, future in batch:
+                    self._send_one(text, future)
+                return
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self._count('batches')
+        self._count('batched_texts', len(batch))
+        for (_, future), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+    def _send_one(self, text, future):
+        try:
+            future.set_result(self.embed_fn(text))
+        except Exception as e:
+            future.set_exception(e)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts['mean_batch_size'] = counts['batched_texts'] / counts['batches'] if counts['batches'] else 0.0
+        return counts
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+from bson.binary import Binary
+
+# Storage format for the 'embedding' field of Mongo documents.
+# 'list' keeps the original BSON array of doubles. 'float32' and 'float16' pack
+# the vector into a Binary blob, roughly a third (or a sixth) of the array's
+# size, which decodes without copying through np.frombuffer. Readers accept
+# every format, so documents can be migrated while the apps are running.
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "list")
+
+# User-defined BSON binary subtypes record the packed dtype
+SUBTYPE_FLOAT32 = 0x80
+SUBTYPE_FLOAT16 = 0x81
+
+DTYPES = {
+    SUBTYPE_FLOAT32: np.dtype('<f4'),
+    SUBTYPE_FLOAT16: np.dtype('<f2'),
+}
+
+SUBTYPES = {
+    'float32': SUBTYPE_FLOAT32,
+    'float16': SUBTYPE_FLOAT16,
+}
+
+
+# Convert an embedding into the value stored in Mongo
+def encode_embedding(embedding, storage=None):
+    storage = storage or EMBEDDING_STORAGE
+    if storage == 'list':
+        return [float(x) for x in embedding]
+    if storage not in SUBTYPES:
+        raise ValueError(f"Unknown embedding storage format: {storage}")
+    subtype = SUBTYPES[storage]
+    return Binary(np.asarray(embedding, dtype=DTYPES[subtype]).tobytes(), subtype)
+
+
+# Convert a stored value back into a vector; packed blobs are read in place
+def decode_embedding(value):
+    if isinstance(value, Binary) and value.subtype in DTYPES:
+        return np.frombuffer(value, dtype=DTYPES[value.subtype])
+    if isinstance(value, (bytes, bytearray)):
+        # Blobs read back without their subtype are assumed to be float32
+        return np.frombuffer(value, dtype=DTYPES[SUBTYPE_FLOAT32])
+    return value
+
+
+# Name of the format a stored value is in
+def storage_format(value):
+    if isinstance(value, Binary) and value.subtype == SUBTYPE_FLOAT16:
+        return 'float16'
+    if isinstance(value, (bytes, bytearray)):
+        return 'float32'
+    return 'list'
@@ -0,0 +1,116 @@
+import os
+import random
+import re
+import time
+import zlib
+
+import numpy as np
+
+# Embedding backends behind create_embedding.
+# Every backend exposes a model name (used in embedding cache keys), embed(text)
+# and embed_many(texts, batch_size). The OpenAI backend calls the embeddings API.
+# The local backend hashes character n-grams and words into a fixed-size vector.
+# It is deterministic, needs no network access and can inject latency, so the
+# rest of the pipeline can be load-tested and benchmarked in isolation.
+#
+# EMBEDDING_PROVIDER selects the backend: openai (default) or local.
+
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", 1536))
+# Simulated latency of the local backend, per call plus per text, with uniform jitter
+LOCAL_EMBEDDING_LATENCY_MS = float(os.getenv("LOCAL_EMBEDDING_LATENCY_MS", 0))
+LOCAL_EMBEDDING_LATENCY_PER_TEXT_MS = float(os.getenv("LOCAL_EMBEDDING_LATENCY_PER_TEXT_MS", 0))
+LOCAL_EMBEDDING_JITTER_MS = float(os.getenv("LOCAL_EMBEDDING_JITTER_MS", 0))
+
+WORD = re.compile(r"\w+")
+
+
+class OpenAIEmbeddingProvider:
+    # policy is an openai_client.CallPolicy applying rate limits, retries and a circuit breaker
+    def __init__(self, client, model=EMBEDDING_MODEL, policy=None):
+        self.client = client
+        self.model = model
+        self.policy = policy
+
+    def _create(self, texts):
+        if self.policy is None:
+            return self.client.embeddings.create(input=texts, model=self.model)
+        return self.policy.call(self.client.embeddings.create, input=texts, model=self.model)
+
+    def embed(self, text):
+        response = self._create(text)
+        return response.data[0].embedding
+
+    # One embeddings.create call per chunk of texts
+    def embed_many(self, texts, batch_size=100):
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            response = self._create(texts[start:start + batch_size])
+            # Each result carries the position of its input within the chunk
+            embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return embeddings
+
+
+# Signed feature hashing of character n-grams and words. Texts sharing words or
+# spellings get similar vectors, which is enough to exercise ranking, though it
+# carries no semantics.
+class HashingEmbeddingProvider:
+    def __init__(self, dim=LOCAL_EMBEDDING_DIM, ngram=3, latency_ms=LOCAL_EMBEDDING_LATENCY_MS,
+                 latency_per_text_ms=LOCAL_EMBEDDING_LATENCY_PER_TEXT_MS, jitter_ms=LOCAL_EMBEDDING_JITTER_MS):
+        self.dim = dim
+        self.ngram = ngram
+        self.latency_ms = latency_ms
+        self.latency_per_text_ms = latency_per_text_ms
+        self.jitter_ms = jitter_ms
+        # Distinct from any API model so cached vectors of the two never mix
+        self.model = f"local-hash-{ngram}gram-{dim}"
+
+    def _features(self, text):
+        text = ' '.join(text.lower().split())
+        padded = f" {text} "
+        for start in range(max(len(padded) - self.ngram + 1, 1)):
+            yield 'c:' + padded[start:start + self.ngram]
+        for word in WORD.findall(text):
+            yield 'w:' + word
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            digest = zlib.crc32(feature.encode('utf-8'))
+            vector[digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def _sleep(self, count):
+        delay_ms = self.latency_ms + self.latency_per_text_ms * count
+        if self.jitter_ms:
+            delay_ms += random.uniform(0, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    def embed(self, text):
+        self._sleep(1)
+        return self._vector(text)
+
+    def embed_many(self, texts, batch_size=100):
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            chunk = texts[start:start + batch_size]
+            self._sleep(len(chunk))
+            embeddings.extend(self._vector(text) for text in chunk)
+        return embeddings
+
+
+# Backend selected by EMBEDDING_PROVIDER; client and policy are used by the API backend
+def make_embedding_provider(client=None, provider=EMBEDDING_PROVIDER, policy=None):
+    if provider == 'local':
+        return HashingEmbeddingProvider()
+    if provider == 'openai':
+        if client is None:
+            from openai_client import make_openai_client
+            client = make_openai_client()
+        return OpenAIEmbeddingProvider(client, policy=policy)
+    raise ValueError(f"Unknown EMBEDDING_PROVIDER: {provider}")
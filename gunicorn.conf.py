@@ -0,0 +1,48 @@
+# gunicorn settings for the session-rag apps, read from config.py.
+#
+# Usage: gunicorn -c gunicorn.conf.py wsgi:app
+#
+# The master imports the heavy libraries once so workers share them copy-on-write,
+# but the app itself is imported in each worker after fork (preload_app = False).
+# A MongoClient starts monitor threads and the OpenAI client holds a connection
+# pool, and neither survives a fork, so each worker creates its own. An exiting worker
+# stops taking requests, finishes the ones in flight within graceful_timeout and then
+# drains its background work.
+
+import sys
+
+import numpy  # noqa: F401
+import pandas  # noqa: F401
+import pymongo  # noqa: F401
+import openai  # noqa: F401
+import flask  # noqa: F401
+
+import config
+
+bind = f"{config.HOST}:{config.PORT}"
+workers = config.WEB_WORKERS
+worker_class = 'gthread'
+threads = config.WEB_THREADS
+timeout = config.WEB_TIMEOUT
+graceful_timeout = config.WEB_GRACEFUL_TIMEOUT
+keepalive = config.WEB_KEEPALIVE
+backlog = config.WEB_BACKLOG
+max_requests = config.WEB_MAX_REQUESTS
+max_requests_jitter = config.WEB_MAX_REQUESTS_JITTER
+loglevel = config.WEB_LOG_LEVEL
+accesslog = '-'
+preload_app = False
+
+
+def post_fork(server, worker):
+    server.log.info("Worker %s forked; it creates its own MongoDB and OpenAI clients", worker.pid)
+
+
+def worker_exit(server, worker):
+    wsgi = sys.modules.get('wsgi')
+    if wsgi is None:
+        return
+    try:
+        wsgi.shutdown()
+    except Exception as e:
+        server.log.warning("Worker %s shutdown failed: %s", worker.pid, e)
@@ -1,21 +1,64 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import pandas as pd
+import numpy as np
 import os
+import logging
+import math
+import re
+import json
 import openai
 import uuid
 import pymongo
 from pymongo import MongoClient
-from datetime import datetime
-from thefuzz import fuzz  # Added for fuzzy matching
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
+from ann_index import AnnIndexManager
+from embedding_cache import make_embedding_cache
+from embedding_coalescer import EmbeddingCoalescer
+from embedding_provider import make_embedding_provider
+from openai_client import OutboundUnavailable, chat_policy, embeddings_policy, make_openai_client
+from embedding_codec import decode_embedding, encode_embedding
+from quantization import LTM_QUANTIZATION, decode_codes, encode_codes, quantize, shortlist
+from scoring import merge_ranked, rank_texts, stack_embeddings
+from ltm_gate import LongTermMemoryGate
+from ltm_queue import LongTermMemoryQueue, MongoJobStore
+from metrics import counter, instrument_flask, register_stats, stage
+from mongo_indexes import provision_indexes
+from reference_matcher import PatternRegistry
+import profiler
+import config
+from sequence import allocate_indices, last_allocated_index, release_indices
+from session_cache import SessionMatrixCache
+
+# JSON serialization of responses, timed as its own stage
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with stage('serialize'):
+            return super().dumps(obj, **kwargs)
 
 # Initialize the Flask app
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
+
+# Per-endpoint latency, in-flight requests and per-stage timings, served on /metrics
+instrument_flask(app)
+EMBEDDING_CALLS = counter('embedding_backend_calls_total', 'Uncached calls to the embedding backend', ('kind',))
+EMBEDDED_TEXTS = counter('embedding_backend_texts_total', 'Texts sent to the embedding backend')
+LLM_GATE_CALLS = counter('llm_gate_calls_total', 'Long-term memory gating calls to the LLM', ('kind', 'decision'))
+
+# Sampling profiler on /debug/profile, off unless PROFILER_ENABLED=1
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
 
 # Set OpenAI API key (ensure the key is stored as an environment variable)
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-from openai import OpenAI
-client = OpenAI()
+# Shared OpenAI client with a bounded connection pool; calls go through per-kind
+# policies with rate limiting, jittered retries and a circuit breaker
+client = make_openai_client()
+embeddings_calls = embeddings_policy()
+chat_calls = chat_policy()
 
 # Set up MongoDB client
 MONGO_URI = os.getenv("MONGO_URI")  # Ensure your MongoDB URI is set in the environment variables
@@ -23,123 +66,574 @@ mongo_client = MongoClient(MONGO_URI)
 db = mongo_client['mydatabase']  # Replace 'mydatabase' with your database name
 embeddings_collection = db['embeddings']  # Collection to store session-based embeddings
 long_term_memory_collection = db['long_term_memory']  # Collection to store long-term memory embeddings
+embedding_cache_collection = db['embedding_cache']  # Collection to store cached embeddings by text hash
+session_counters_collection = db['session_counters']  # Collection to store the last message index per session
+long_term_jobs_collection = db['long_term_memory_jobs']  # Collection to store queued long-term memory job outcomes
+
+# Create the session and long-term memory indexes and check the hot query plans
+provision_indexes(db)
+
+# Embedding backend selected by EMBEDDING_PROVIDER: the OpenAI API or a local stand-in for benchmarks
+embedding_provider = make_embedding_provider(client, policy=embeddings_calls)
+
+# Cache of embeddings keyed by model and normalized text
+embedding_cache = make_embedding_cache(embedding_provider.model, embedding_cache_collection)
+
+# In-process cache of per-session embedding matrices, bounded by bytes and session count
+session_cache = SessionMatrixCache(
+    max_bytes=int(os.getenv("SESSION_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    max_sessions=int(os.getenv("SESSION_CACHE_MAX_SESSIONS", 1000)),
+    # Seconds after which a missing message index is taken as never arriving
+    hole_ttl=float(os.getenv("SESSION_CACHE_HOLE_TTL", 120))
+)
+
+# Approximate nearest neighbour indexes, used above ANN_THRESHOLD vectors when hnswlib is installed
+session_ann = AnnIndexManager('sessions')
+long_term_ann = AnnIndexManager('long_term_memory')
 
-# Embedding creation function
+# Reference patterns loaded from REFERENCE_PATTERNS_PATH, recompiled and swapped in when the file changes
+reference_patterns = PatternRegistry()
+
+# Number of texts sent per embedding backend call for bulk ingestion
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 100))
+
+# Largest page /get_session_data serves in one response
+SESSION_DATA_MAX_LIMIT = int(os.getenv("SESSION_DATA_MAX_LIMIT", 1000))
+
+# Threads that run embedding calls while the same request waits on MongoDB
+io_executor = ThreadPoolExecutor(max_workers=int(os.getenv("IO_THREADS", 32)), thread_name_prefix='io')
+
+# Threads that run the long-term side of a combined search; kept apart from io_executor
+# so a search waiting on its query embedding never holds a thread the embedding needs
+search_executor = ThreadPoolExecutor(max_workers=int(os.getenv("IO_THREADS", 32)), thread_name_prefix='search')
+
+# Embedding creation function, served from the embedding cache when possible; misses
+# go through the coalescer so concurrent requests for one text share a backend call
 def create_embedding(text):
-    response = client.embeddings.create(
-        input=text,
-        model="text-embedding-3-small"
-    )
-    return response.data[0].embedding
+    return embedding_cache.get_or_create(text, embedding_coalescer.embed)
 
-# Add a new text and its embedding to MongoDB (session-based)
-def add_text_to_db(session_id, text):
-    text_embedding = create_embedding(text)
-    # Get the highest index in the session
-    last_doc = embeddings_collection.find({'session_id': session_id}).sort('index', -1).limit(1)
+# Uncached call to the embedding backend
+def embed_text(text):
+    EMBEDDING_CALLS.inc(kind='single')
+    EMBEDDED_TEXTS.inc()
+    with stage('embed'):
+        return embedding_provider.embed(text)
+
+# Batch embedding creation, only texts missing from the embedding cache are sent to the API
+def create_embeddings(texts):
+    return embedding_cache.get_or_create_many(texts, embed_texts)
+
+# Uncached batch call, one backend call per chunk of texts
+def embed_texts(texts, batch_size=EMBEDDING_BATCH_SIZE):
+    EMBEDDING_CALLS.inc(kind='batch')
+    EMBEDDED_TEXTS.inc(len(texts))
+    with stage('embed_batch'):
+        return embedding_provider.embed_many(texts, batch_size)
+
+# One backend call for the distinct texts the coalescer collected within its window
+def embed_micro_batch(texts):
+    EMBEDDING_CALLS.inc(kind='micro_batch')
+    EMBEDDED_TEXTS.inc(len(texts))
+    with stage('embed_micro_batch'):
+        return embedding_provider.embed_many(texts, EMBEDDING_BATCH_SIZE)
+
+# Single-flight and micro-batching for create_embedding misses, tuned by
+# EMBEDDING_BATCH_WINDOW_MS (0 sends each text on its own), EMBEDDING_BATCH_MAX and
+# EMBEDDING_BATCH_CONCURRENCY. A batch the API rejects is retried text by text, so
+# one bad input does not fail the requests it was batched with.
+embedding_coalescer = EmbeddingCoalescer(
+    embedding_provider.model, embed_text, embed_micro_batch, split_errors=(openai.BadRequestError,)
+)
+
+# Wait for a query embedding started alongside the database work; this is the part
+# of the embedding latency the overlap did not hide
+def query_embedding_result(query_future):
+    with stage('embed_wait'):
+        return query_future.result()
+
+# Get the highest index in the session
+def get_last_index(session_id):
+    # Projecting only the index lets the (session_id, index) index cover the query
+    with stage('mongo_last_index'):
+        last_doc = list(embeddings_collection.find({'session_id': session_id}, {'_id': 0, 'index': 1}).sort('index', -1).limit(1))
     last_index = 0
     for doc in last_doc:
         last_index = doc.get('index', 0)
-    index = last_index + 1
+    return last_index
+
+# Whether the session has any stored text
+def session_has_data(session_id):
+    with stage('mongo_count'):
+        return embeddings_collection.count_documents({'session_id': session_id}, limit=1) > 0
+
+# Add a new text and its embedding to MongoDB (session-based)
+def add_text_to_db(session_id, text):
+    embedding_future = io_executor.submit(create_embedding, text)
+    # Atomically reserve the next index in the session while the text is embedded
+    with stage('mongo_allocate'):
+        index = allocate_indices(session_counters_collection, embeddings_collection, session_id)
+    text_embedding = reserved_result(embedding_future, session_id, index, 1)
     document = {
         'session_id': session_id,
         'text': text,
-        'embedding': text_embedding,
+        'embedding': encode_embedding(text_embedding),
         'timestamp': datetime.utcnow(),
         'index': index
     }
-    embeddings_collection.insert_one(document)
+    with stage('mongo_insert'):
+        embeddings_collection.insert_one(document)
+    session_cache.append(session_id, [text], [text_embedding], [index])
+    session_ann.add(session_id, [index], [text_embedding])
     return document
 
-# Function to rank texts by relatedness (session-based)
-def texts_ranked_by_relatedness(query, session_id, top_n=100):
-    query_embedding = create_embedding(query)
-    
-    # Fetch all embeddings for the session_id
-    cursor = embeddings_collection.find({'session_id': session_id})
-    
-    texts = []
-    embeddings = []
-    for doc in cursor:
-        texts.append(doc['text'])
-        embeddings.append(doc['embedding'])
-    
-    # Compute similarities
-    from scipy import spatial
-    relatedness_scores = [1 - spatial.distance.cosine(query_embedding, emb) for emb in embeddings]
-    
-    # Combine texts and scores
-    texts_and_scores = list(zip(texts, relatedness_scores))
-    
-    # Sort by scores
-    texts_and_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Get top N
-    top_texts_and_scores = texts_and_scores[:top_n]
-    
-    top_texts = [t[0] for t in top_texts_and_scores]
-    top_scores = [t[1] for t in top_texts_and_scores]
-    
-    return top_texts, top_scores
+# Add several texts to a session with batched embeddings and a single insert
+def add_texts_to_db(session_id, texts):
+    embeddings_future = io_executor.submit(create_embeddings, texts)
+    # Atomically reserve a block of consecutive indices while the texts are embedded
+    with stage('mongo_allocate'):
+        first_index = allocate_indices(session_counters_collection, embeddings_collection, session_id, len(texts))
+    text_embeddings = reserved_result(embeddings_future, session_id, first_index, len(texts))
+    indices = list(range(first_index, first_index + len(texts)))
+    timestamp = datetime.utcnow()
+    documents = [
+        {
+            'session_id': session_id,
+            'text': text,
+            'embedding': encode_embedding(text_embedding),
+            'timestamp': timestamp,
+            'index': index
+        }
+        for text, text_embedding, index in zip(texts, text_embeddings, indices)
+    ]
+    with stage('mongo_insert'):
+        embeddings_collection.insert_many(documents)
+    session_cache.append(session_id, texts, text_embeddings, indices)
+    session_ann.add(session_id, indices, text_embeddings)
+    return documents
+
+# Result of an embedding call made alongside an index reservation; if it fails the
+# reservation is handed back so the session is not left with a hole
+def reserved_result(future, session_id, first_index, count):
+    try:
+        return future.result()
+    except Exception:
+        release_indices(session_counters_collection, session_id, first_index, count)
+        raise
+
+# Fetch texts, embeddings and indices for a session query, in index order; with
+# last_k only the last K matching rows are read
+def fetch_session_rows(query, last_k=None):
+    cursor = embeddings_collection.find(query, {'_id': 0, 'text': 1, 'embedding': 1, 'index': 1})
+    if last_k is not None:
+        cursor = cursor.sort('index', -1).limit(last_k)
+    else:
+        cursor = cursor.sort('index', 1)
+    with stage('mongo_fetch'):
+        docs = list(cursor)
+    texts = [doc['text'] for doc in docs]
+    indices = [doc.get('index', 0) for doc in docs]
+    with stage('decode'):
+        embeddings = [decode_embedding(doc['embedding']) for doc in docs]
+    if last_k is not None:
+        texts.reverse()
+        embeddings.reverse()
+        indices.reverse()
+    return texts, embeddings, indices
+
+# Cached (texts, matrix, indices) of the session if the cache is current, else None
+def cached_session_matrix(session_id, latest_index):
+    # Rows for recent holes may still be in flight; while none of them has landed the
+    # cached copy is as complete as a reload would be
+    holes = session_cache.recent_holes(session_id, latest_index)
+    landed = False
+    if holes:
+        with stage('mongo_hole_check'):
+            landed = embeddings_collection.count_documents({'session_id': session_id, 'index': {'$in': holes}}, limit=1) > 0
+    return session_cache.get(session_id, latest_index, allow_recent_holes=bool(holes) and not landed)
+
+# Load the session's texts, embedding matrix and indices, using the cache when it is current
+def load_session_matrix(session_id):
+    # The latest index tells us whether another worker has written to the session
+    latest_index = get_last_index(session_id)
+    cached = cached_session_matrix(session_id, latest_index)
+    if cached is not None:
+        return cached
+
+    # Only fetch the rows written since the cached copy, if there is one
+    cached_index = session_cache.last_index(session_id)
+    if cached_index is not None and cached_index < latest_index:
+        rows = fetch_session_rows({'session_id': session_id, 'index': {'$gt': cached_index}})
+        if session_cache.append(session_id, *rows, contiguous=False):
+            cached = session_cache.get(session_id, latest_index)
+            if cached is not None:
+                return cached
+
+    # Cold session, a filled hole, or a refresh that did not line up: reload it in full
+    return session_cache.put(session_id, *fetch_session_rows({'session_id': session_id}))
+
+# Parse the session search options of a request into (filters, recency), raising
+# ValueError for malformed values. Filters select rows by index range (index_from,
+# index_to, inclusive), time window (since, until as ISO 8601) or the last K messages;
+# recency blends the cosine score with a decay of recency_half_life messages.
+def session_search_options(data):
+    filters = {}
+    for name in ('index_from', 'index_to', 'last_k'):
+        if data.get(name) is not None:
+            filters[name] = int(data[name])
+    if filters.get('last_k') is not None and filters['last_k'] < 1:
+        raise ValueError('last_k must be at least 1')
+    for name in ('since', 'until'):
+        if data.get(name):
+            timestamp = datetime.fromisoformat(data[name])
+            # Stored timestamps are naive UTC
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+            filters[name] = timestamp
+    recency = {
+        'recency_weight': float(data.get('recency_weight', 0.0)),
+        'half_life': float(data.get('recency_half_life', 20.0))
+    }
+    if not 0.0 <= recency['recency_weight'] <= 1.0:
+        raise ValueError('recency_weight must be between 0 and 1')
+    if recency['half_life'] <= 0:
+        raise ValueError('recency_half_life must be positive')
+    return filters, recency
+
+# Session rows selected by the filters. Index filters are applied to the cached matrix when
+# it is current; otherwise, and for time windows, they are pushed into the Mongo query so
+# only the selected vectors are read.
+def load_filtered_session_rows(session_id, filters):
+    index_from = filters.get('index_from')
+    index_to = filters.get('index_to')
+    last_k = filters.get('last_k')
+    
+    if 'since' not in filters and 'until' not in filters:
+        cached = cached_session_matrix(session_id, get_last_index(session_id))
+        if cached is not None:
+            texts, matrix, indices = cached
+            mask = np.ones(len(indices), dtype=bool)
+            if index_from is not None:
+                mask &= indices >= index_from
+            if index_to is not None:
+                mask &= indices <= index_to
+            positions = np.flatnonzero(mask)
+            if last_k is not None:
+                positions = positions[-last_k:]
+            return [texts[position] for position in positions], matrix[positions], indices[positions]
+    
+    query = {'session_id': session_id}
+    if index_from is not None or index_to is not None:
+        query['index'] = {}
+        if index_from is not None:
+            query['index']['$gte'] = index_from
+        if index_to is not None:
+            query['index']['$lte'] = index_to
+    if 'since' in filters or 'until' in filters:
+        query['timestamp'] = {}
+        if 'since' in filters:
+            query['timestamp']['$gte'] = filters['since']
+        if 'until' in filters:
+            query['timestamp']['$lte'] = filters['until']
+    texts, embeddings, indices = fetch_session_rows(query, last_k)
+    return texts, stack_embeddings(embeddings), np.asarray(indices, dtype=np.int64)
+
+# Function to rank texts by relatedness (session-based), None if the session has no data.
+# query_future is the query's pending embedding when the caller shares it between searches;
+# filters and recency come from session_search_options.
+def texts_ranked_by_relatedness(query, session_id, top_n=100, query_future=None, filters=None, recency=None):
+    # Embed the query while the session is loaded
+    owns_future = query_future is None
+    if owns_future:
+        query_future = io_executor.submit(create_embedding, query)
+    
+    # Fetch the embeddings for the session_id, or only the filtered rows, from the cache when possible
+    if filters:
+        texts, matrix, indices = load_filtered_session_rows(session_id, filters)
+    else:
+        texts, matrix, indices = load_session_matrix(session_id)
+    if not texts:
+        if owns_future:
+            query_future.cancel()
+        # Filters that select no rows of a session with data give an empty result, not a 404
+        if filters and session_has_data(session_id):
+            return [], []
+        return None
+    
+    query_embedding = query_embedding_result(query_future)
+    
+    # Recency counts messages back from the newest message searched
+    if recency and recency['recency_weight'] > 0:
+        ages = indices.max() - indices
+        with stage('score'):
+            return rank_texts(query_embedding, texts, matrix, top_n, ages, **recency)
+    
+    # Large unfiltered sessions are searched through their ANN index, keyed by message index
+    if filters:
+        with stage('score'):
+            return rank_texts(query_embedding, texts, matrix, top_n)
+    with stage('ann_search'):
+        # Sessions written before the atomic counter can repeat an index, which the ANN index stores once
+        result = session_ann.search(
+            session_id, query_embedding, top_n, int(np.unique(indices).size),
+            lambda last_index: session_rows_after(matrix, indices, last_index),
+            lambda: (indices.tolist(), matrix),
+            lambda ids: np.isin(ids, indices)
+        )
+    if result is not None:
+        top_indices, top_scores = result
+        return [texts[position] for position in np.searchsorted(indices, top_indices)], top_scores
+    
+    # Score every document with one matrix-vector product
+    with stage('score'):
+        return rank_texts(query_embedding, texts, matrix, top_n)
+
+# Cached session rows written after the given message index
+def session_rows_after(matrix, indices, last_index):
+    mask = indices > last_index
+    return indices[mask].tolist(), matrix[mask]
 
 # Function to decide whether to store text in long-term memory
 def should_store_in_long_term_memory(prompt):
-    completion = client.chat.completions.create(
-      model="gpt-4o",
-      messages=[
-        {"role": "system", "content": "You are a long term memory boolean program"},
-        {"role": "user", "content": f"This is the prompt {prompt} Tell me if it is valuable information to store about the user or not Give either 0 or 1 as output no other text "}
-      ]
-    )
+    with stage('llm_gate'):
+        completion = chat_calls.call(
+          client.chat.completions.create,
+          model="gpt-4o",
+          messages=[
+            {"role": "system", "content": "You are a long term memory boolean program"},
+            {"role": "user", "content": f"This is the prompt {prompt} Tell me if it is valuable information to store about the user or not Give either 0 or 1 as output no other text "}
+          ]
+        )
     response = completion.choices[0].message.content.strip()
-    print("The response of the Boolean long term memory is ", response)
+    LLM_GATE_CALLS.inc(kind='single', decision=response if response in ('0', '1') else 'other')
     return response
 
+# Batched variant for the ingestion queue: one completion answers for a numbered list of texts
+def should_store_batch_in_long_term_memory(prompts):
+    numbered = "\n".join(f"{n}. {prompt}" for n, prompt in enumerate(prompts, 1))
+    with stage('llm_gate_batch'):
+        completion = chat_calls.call(
+          client.chat.completions.create,
+          model="gpt-4o",
+          messages=[
+            {"role": "system", "content": "You are a long term memory boolean program"},
+            {"role": "user", "content": f"These are the prompts:\n{numbered}\nFor each prompt tell me if it is valuable information to store about the user or not. Give a JSON array with one 0 or 1 per prompt, in order, no other text "}
+          ]
+        )
+    response = completion.choices[0].message.content.strip()
+    try:
+        decisions = [str(int(decision)) for decision in json.loads(re.search(r"\[.*\]", response, re.S).group(0))]
+    except (AttributeError, ValueError, TypeError):
+        decisions = []
+    if len(decisions) != len(prompts):
+        # Malformed answer, fall back to one call per prompt
+        LLM_GATE_CALLS.inc(kind='batch', decision='malformed')
+        return [should_store_in_long_term_memory(prompt) for prompt in prompts]
+    for decision in decisions:
+        LLM_GATE_CALLS.inc(kind='batch', decision=decision if decision in ('0', '1') else 'other')
+    return decisions
+
+# Stored fields for a long-term memory embedding, with its compact code when quantization is on
+def long_term_embedding_fields(text_embedding):
+    fields = {'embedding': encode_embedding(text_embedding)}
+    if LTM_QUANTIZATION != 'none':
+        fields.update(encode_codes(text_embedding))
+    return fields
+
+# Local rules decide the obvious cases and only ambiguous texts reach the LLM; decisions are memoized
+long_term_gate = LongTermMemoryGate(should_store_in_long_term_memory)
+
 # Add a new text to long-term memory
 def add_text_to_long_term_memory(uuid, text):
     text_embedding = create_embedding(text)
     document = {
         'uuid': uuid,
         'text': text,
-        'embedding': text_embedding,
+        **long_term_embedding_fields(text_embedding),
         'timestamp': datetime.utcnow()
     }
     long_term_memory_collection.insert_one(document)
+    long_term_ann.add(uuid, [str(document['_id'])], [text_embedding])
     return document
 
-# Function to rank texts by relatedness in long-term memory
-def texts_ranked_by_relatedness_long_term(query, uuid, top_n=100):
-    query_embedding = create_embedding(query)
-    
-    # Fetch all embeddings for the uuid
-    cursor = long_term_memory_collection.find({'uuid': uuid})
-    
-    texts = []
+# Add several texts to long-term memory with batched embeddings and a single insert
+def add_texts_to_long_term_memory(uuid, texts):
+    return insert_long_term_memories(uuid, texts, create_embeddings(texts))
+
+# Bulk-insert already embedded texts of one user into long-term memory
+def insert_long_term_memories(uuid, texts, text_embeddings):
+    timestamp = datetime.utcnow()
+    documents = [
+        {
+            'uuid': uuid,
+            'text': text,
+            **long_term_embedding_fields(text_embedding),
+            'timestamp': timestamp
+        }
+        for text, text_embedding in zip(texts, text_embeddings)
+    ]
+    long_term_memory_collection.insert_many(documents)
+    long_term_ann.add(uuid, [str(doc['_id']) for doc in documents], text_embeddings)
+    return documents
+
+# Background queue that gates, embeds and stores long-term memories in batches
+# Job outcomes are kept in MongoDB so a status poll can reach any worker
+long_term_queue = LongTermMemoryQueue(
+    long_term_gate, should_store_batch_in_long_term_memory, create_embeddings, insert_long_term_memories,
+    jobs=MongoJobStore(long_term_jobs_collection)
+)
+
+# Validate the 'texts' field of a bulk request, returning an error message or None
+def validate_texts(texts):
+    if not texts:
+        return 'Texts are required'
+    if not isinstance(texts, list) or not all(isinstance(text, str) and text for text in texts):
+        return 'Texts must be a list of non-empty strings'
+    return None
+
+# Function to rank texts by relatedness in long-term memory, None if the user has no data.
+# query_future is the query's pending embedding when the caller shares it between searches.
+def texts_ranked_by_relatedness_long_term(query, uuid, top_n=100, query_future=None):
+    # Embed the query while the memories are fetched
+    owns_future = query_future is None
+    if owns_future:
+        query_future = io_executor.submit(create_embedding, query)
+    
+    # Users with many memories are searched through their ANN index, which needs the count to stay
+    # in sync. Users without an index that were well below the threshold skip the count.
+    if long_term_ann.should_count(uuid):
+        with stage('mongo_count'):
+            count = long_term_memory_collection.count_documents({'uuid': uuid})
+        if count == 0:
+            if owns_future:
+                query_future.cancel()
+            return None
+        query_embedding = query_embedding_result(query_future)
+        with stage('ann_search'):
+            result = long_term_ann.search(
+                uuid, query_embedding, top_n, count,
+                lambda last_id: fetch_long_term_vectors(uuid, last_id),
+                lambda: fetch_long_term_vectors(uuid)
+            )
+        if result is not None:
+            top_ids, top_scores = result
+            docs = long_term_memory_collection.find({'_id': {'$in': [ObjectId(doc_id) for doc_id in top_ids]}}, {'text': 1})
+            texts_by_id = {str(doc['_id']): doc['text'] for doc in docs}
+            found = [(texts_by_id[doc_id], score) for doc_id, score in zip(top_ids, top_scores) if doc_id in texts_by_id]
+            return [text for text, _ in found], [score for _, score in found]
+    
+    if LTM_QUANTIZATION != 'none':
+        result = texts_ranked_by_relatedness_long_term_quantized(query_future, uuid, top_n)
+        if result is None and owns_future:
+            query_future.cancel()
+        return result
+    
+    # Fetch all embeddings for the uuid, leaving out fields the ranking does not use
+    cursor = long_term_memory_collection.find({'uuid': uuid}, {'_id': 0, 'text': 1, 'embedding': 1})
+    with stage('mongo_fetch'):
+        docs = list(cursor)
+    texts = [doc['text'] for doc in docs]
+    long_term_ann.observe(uuid, len(texts))
+    with stage('decode'):
+        embeddings = [decode_embedding(doc['embedding']) for doc in docs]
+    if not texts:
+        if owns_future:
+            query_future.cancel()
+        return None
+    
+    query_embedding = query_embedding_result(query_future)
+    
+    # Score every document with one matrix-vector product
+    with stage('score'):
+        return rank_texts(query_embedding, texts, stack_embeddings(embeddings), top_n)
+
+# Long-term memory ids and embeddings for a user, optionally only those after a document id
+def fetch_long_term_vectors(uuid, after_id=None):
+    query = {'uuid': uuid}
+    if after_id is not None:
+        query['_id'] = {'$gt': ObjectId(after_id)}
+    ids = []
     embeddings = []
+    for doc in long_term_memory_collection.find(query, {'embedding': 1}).sort('_id', 1):
+        ids.append(str(doc['_id']))
+        embeddings.append(decode_embedding(doc['embedding']))
+    return ids, stack_embeddings(embeddings)
+
+# Score the compact codes of every memory, then rescore a shortlist at full precision.
+# query_future is the pending embedding of the query.
+def texts_ranked_by_relatedness_long_term_quantized(query_future, uuid, top_n=100):
+    cursor = long_term_memory_collection.find({'uuid': uuid}, {'embedding_q': 1, 'embedding_scale': 1})
+    
+    ids = []
+    codes = []
+    scales = []
+    uncoded_ids = []
     for doc in cursor:
-        texts.append(doc['text'])
-        embeddings.append(doc['embedding'])
-    
-    # Compute similarities
-    from scipy import spatial
-    relatedness_scores = [1 - spatial.distance.cosine(query_embedding, emb) for emb in embeddings]
-    
-    # Combine texts and scores
-    texts_and_scores = list(zip(texts, relatedness_scores))
-    
-    # Sort by scores
-    texts_and_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Get top N
-    top_texts_and_scores = texts_and_scores[:top_n]
-    
-    top_texts = [t[0] for t in top_texts_and_scores]
-    top_scores = [t[1] for t in top_texts_and_scores]
-    
-    return top_texts, top_scores
+        decoded = decode_codes(doc)
+        if decoded is None:
+            uncoded_ids.append(doc['_id'])
+            continue
+        ids.append(doc['_id'])
+        codes.append(decoded[0])
+        scales.append(decoded[1])
+    
+    # Memories stored before quantization was turned on are coded on the fly
+    if uncoded_ids:
+        for doc in long_term_memory_collection.find({'_id': {'$in': uncoded_ids}}, {'embedding': 1}):
+            doc_codes, doc_scales = quantize(decode_embedding(doc['embedding']), LTM_QUANTIZATION)
+            ids.append(doc['_id'])
+            codes.append(doc_codes[0])
+            scales.append(doc_scales[0])
+    
+    long_term_ann.observe(uuid, len(ids))
+    if not ids:
+        return None
+    
+    query_embedding = query_embedding_result(query_future)
+    
+    # Fetch text and full-precision embeddings for the shortlist only
+    candidates = shortlist(np.vstack(codes), np.asarray(scales, dtype=np.float32), query_embedding, top_n)
+    candidate_ids = [ids[i] for i in candidates]
+    docs = {doc['_id']: doc for doc in long_term_memory_collection.find({'_id': {'$in': candidate_ids}}, {'text': 1, 'embedding': 1})}
+    candidate_ids = [doc_id for doc_id in candidate_ids if doc_id in docs]
+    
+    texts = [docs[doc_id]['text'] for doc_id in candidate_ids]
+    embeddings = [decode_embedding(docs[doc_id]['embedding']) for doc_id in candidate_ids]
+    with stage('score'):
+        return rank_texts(query_embedding, texts, stack_embeddings(embeddings), top_n)
+
+# Messages referenced relative to the current message, fetched in one indexed query
+def get_referenced_messages(session_id, relative_indices):
+    # The current message is not stored yet, so it takes the next index
+    current_index = last_allocated_index(session_counters_collection, embeddings_collection, session_id) + 1
+    targets = {current_index - x: x for x in relative_indices if current_index - x >= 1}
+    if not targets:
+        return []
+    
+    cursor = embeddings_collection.find(
+        {'session_id': session_id, 'index': {'$in': list(targets)}},
+        {'_id': 0, 'text': 1, 'timestamp': 1, 'index': 1}
+    )
+    messages = [
+        {
+            'relative_index': targets[doc['index']],
+            'index': doc['index'],
+            'text': doc['text'],
+            'timestamp': doc.get('timestamp')
+        }
+        for doc in cursor
+    ]
+    messages.sort(key=lambda message: message['relative_index'])
+    return messages
 
 # Flask routes
 
+# OpenAI calls rejected by the rate limiter or an open circuit answer 503 with Retry-After
+@app.errorhandler(OutboundUnavailable)
+def outbound_unavailable(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
 # Route to add text for a specific session
 @app.route('/add_text', methods=['POST'])
 def add_text():
@@ -157,6 +651,24 @@ def add_text():
     
     return jsonify({'message': 'Text added successfully', 'text': text}), 200
 
+# Route to add several texts for a specific session in one request
+@app.route('/add_texts', methods=['POST'])
+def add_texts():
+    data = request.json
+    session_id = data.get('session_id')
+    texts = data.get('texts')
+    
+    if not session_id:
+        return jsonify({'error': 'Session ID is required'}), 400
+    error = validate_texts(texts)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    # Embed in batches and insert all documents at once
+    documents = add_texts_to_db(session_id, texts)
+    
+    return jsonify({'message': 'Texts added successfully', 'count': len(documents), 'indices': [doc['index'] for doc in documents]}), 200
+
 # Route to search for relevant texts for a specific session
 @app.route('/search', methods=['POST'])
 def search():
@@ -169,13 +681,16 @@ def search():
         return jsonify({'error': 'Session ID is required'}), 400
     if not query:
         return jsonify({'error': 'Query is required'}), 400
-    
-    # Check if there is data for the session_id
-    if embeddings_collection.count_documents({'session_id': session_id}) == 0:
+    try:
+        filters, recency = session_search_options(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid search options: {e}'}), 400
+    
+    # Perform the search; a session without documents has no data to search
+    result = texts_ranked_by_relatedness(query, session_id, top_n, filters=filters, recency=recency)
+    if result is None:
         return jsonify({'error': f'No data found for session_id {session_id}'}), 404
-    
-    # Perform the search
-    top_texts, top_scores = texts_ranked_by_relatedness(query, session_id, top_n)
+    top_texts, top_scores = result
     
     return jsonify({'top_texts': top_texts, 'top_scores': top_scores}), 200
 
@@ -186,21 +701,49 @@ def get_session_data():
     
     if not session_id:
         return jsonify({'error': 'Session ID is required'}), 400
-    
-    cursor = embeddings_collection.find({'session_id': session_id})
-    data = []
-    for doc in cursor:
-        data.append({
-            'text': doc['text'],
-            'timestamp': doc.get('timestamp'),
-            'index': doc.get('index')
-        })
+    try:
+        after = int(request.args['after']) if 'after' in request.args else None
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'after and limit must be integers'}), 400
+    if limit is not None and not 0 < limit <= SESSION_DATA_MAX_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {SESSION_DATA_MAX_LIMIT}'}), 400
+    
+    # Only the returned fields are read, so the embeddings never leave MongoDB
+    query = {'session_id': session_id}
+    if after is not None:
+        query['index'] = {'$gt': after}
+    cursor = embeddings_collection.find(query, {'_id': 0, 'text': 1, 'timestamp': 1, 'index': 1}).sort('index', 1)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    
+    # Newline-delimited JSON, written as the cursor yields documents
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for doc in cursor:
+                yield app.json.dumps(session_message(doc)) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    
+    data = [session_message(doc) for doc in cursor]
+    
+    # A page carries the cursor for the next one, None once the session is exhausted
+    if limit is not None:
+        next_after = data[-1]['index'] if len(data) == limit else None
+        return jsonify({'messages': data, 'next_after': next_after}), 200
     
     if not data:
         return jsonify({'error': 'No data found for session_id'}), 404
     
     return jsonify(data), 200
 
+# Public fields of a stored session message
+def session_message(doc):
+    return {
+        'text': doc['text'],
+        'timestamp': doc.get('timestamp'),
+        'index': doc.get('index')
+    }
+
 # Route to add text to long-term memory, conditionally
 @app.route('/add_to_long_term_memory', methods=['POST'])
 def add_to_long_term_memory():
@@ -213,8 +756,13 @@ def add_to_long_term_memory():
     if not text:
         return jsonify({'error': 'Text is required'}), 400
     
+    # Queue the text and answer right away; the job id reports the outcome
+    if data.get('async'):
+        job_id = long_term_queue.submit(uuid, [text])
+        return jsonify({'message': 'Text queued for long-term memory', 'job_id': job_id}), 202
+    
     # Decide whether to store the text
-    store_decision = should_store_in_long_term_memory(text)
+    store_decision = long_term_gate.decide(text)
     
     if store_decision == '1':
         # Add text to long-term memory
@@ -223,6 +771,41 @@ def add_to_long_term_memory():
     else:
         return jsonify({'message': 'Text not added to long-term memory'}), 200
 
+# Route to add several texts to long-term memory, conditionally unless gating is turned off
+@app.route('/add_texts_to_long_term_memory', methods=['POST'])
+def add_texts_to_long_term_memory_route():
+    data = request.json
+    uuid = data.get('uuid')
+    texts = data.get('texts')
+    gate = data.get('gate', True)  # Set to false to store every text, e.g. for imports
+    
+    if not uuid:
+        return jsonify({'error': 'User ID (uuid) is required'}), 400
+    error = validate_texts(texts)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    # Gated texts can be queued; the job id reports which of them were stored
+    if gate and data.get('async'):
+        job_id = long_term_queue.submit(uuid, texts)
+        return jsonify({'message': 'Texts queued for long-term memory', 'job_id': job_id, 'count': len(texts)}), 202
+
+    # Decide which texts to store
+    if gate:
+        texts = [text for text in texts if long_term_gate.decide(text) == '1']
+    
+    if texts:
+        add_texts_to_long_term_memory(uuid, texts)
+    return jsonify({'message': 'Texts added to long-term memory', 'count': len(texts), 'texts': texts}), 200
+
+# Route to report the status of a queued long-term memory job
+@app.route('/long_term_memory_jobs/<job_id>', methods=['GET'])
+def long_term_memory_job(job_id):
+    job = long_term_queue.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job_id'}), 404
+    return jsonify(job), 200
+
 # Route to search long-term memory using uuid and query
 @app.route('/search_long_term_memory', methods=['POST'])
 def search_long_term_memory():
@@ -236,15 +819,60 @@ def search_long_term_memory():
     if not query:
         return jsonify({'error': 'Query is required'}), 400
     
-    # Check if there is data for the uuid
-    if long_term_memory_collection.count_documents({'uuid': uuid}) == 0:
+    # Perform the search; a user without memories has no data to search
+    result = texts_ranked_by_relatedness_long_term(query, uuid, top_n)
+    if result is None:
         return jsonify({'error': f'No data found for user {uuid}'}), 404
-    
-    # Perform the search
-    top_texts, top_scores = texts_ranked_by_relatedness_long_term(query, uuid, top_n)
+    top_texts, top_scores = result
     
     return jsonify({'top_texts': top_texts, 'top_scores': top_scores}), 200
 
+# Route to search the session and long-term memory with one query embedding, merging
+# the results by weighted score and tagging each with the store it came from
+@app.route('/search_combined', methods=['POST'])
+def search_combined():
+    data = request.json
+    session_id = data.get('session_id')
+    uuid = data.get('uuid')
+    query = data.get('query')
+    top_n = data.get('top_n', 100)  # Default to 100 if not specified
+    
+    if not session_id and not uuid:
+        return jsonify({'error': 'Session ID or user ID (uuid) is required'}), 400
+    if not query:
+        return jsonify({'error': 'Query is required'}), 400
+    try:
+        filters, recency = session_search_options(data)
+        weights = {
+            'session': float(data.get('session_weight', 1.0)),
+            'long_term': float(data.get('long_term_weight', 1.0))
+        }
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid search options: {e}'}), 400
+    
+    # Embed once and search both stores while the embedding is in flight
+    query_future = io_executor.submit(create_embedding, query)
+    long_term_future = None
+    if uuid:
+        long_term_future = search_executor.submit(texts_ranked_by_relatedness_long_term, query, uuid, top_n, query_future)
+    results = {}
+    if session_id:
+        results['session'] = texts_ranked_by_relatedness(query, session_id, top_n, query_future, filters, recency)
+    if long_term_future is not None:
+        results['long_term'] = long_term_future.result()
+    
+    if all(result is None for result in results.values()):
+        return jsonify({'error': 'No data found for session_id or uuid'}), 404
+    response = {'results': merge_ranked(results, weights, top_n)}
+    
+    # Messages the query refers back to, resolved by the same patterns as /resolve_references
+    if data.get('include_references') and session_id:
+        relative_indices = reference_patterns.resolve(query)
+        response['relative_indices'] = relative_indices
+        response['references'] = get_referenced_messages(session_id, relative_indices) if relative_indices else []
+    
+    return jsonify(response), 200
+
 # Updated Route to resolve references in the current session using heuristic approach
 @app.route('/resolve_references', methods=['POST'])
 def resolve_references():
@@ -257,55 +885,69 @@ def resolve_references():
     if not text:
         return jsonify({'error': 'Text is required'}), 400
 
-    # Get the current index for the session
-    last_doc = embeddings_collection.find({'session_id': session_id}).sort('index', -1).limit(1)
-    last_index = 0
-    for doc in last_doc:
-        last_index = doc.get('index', 0)
-    current_index = last_index + 1  # Index of the current message
-
-    # Lowercase the current message
-    text_lower = text.lower()
-
-    # Heuristic rules to determine references
-    relative_indices = []
-
-    # Expanded patterns with additional keywords and phrases
-    patterns = [
-        (('it', 'this', 'that'), [1]),
-        (('they', 'them', 'those', 'these'), [1, 2]),
-        (('which one', 'which ones'), [1, 2]),
-        (('what was my last message', 'what did i just say'), [1]),
-        (('tell me more about', 'elaborate on'), [1]),
-        (('earlier', 'previously', 'before', 'earlier you mentioned'), [1, 2, 3]),
-        (('as mentioned', 'as i said', 'as you said', 'as previously noted'), [1, 2]),
-        (('above', 'above message', 'prior message'), [1, 2]),
-        (('in your last message', 'in your previous message', 'you previously said'), [1]),
-        (('what did you say about', 'can you remind me about'), [1]),
-        (('remind me about', 'refresh my memory on'), [1]),
-        (('more details on', 'more information on', 'explain further about', 'go deeper into'), [1]),
-        (('the previous topic', 'the earlier discussion', 'the last point'), [1, 2]),
-        # Additional patterns to cover more cases
-        (('continue with', 'continue about'), [1]),
-        (('can you expand on', 'could you elaborate'), [1]),
-        (('what do you mean by', 'clarify about'), [1]),
-        (('i am confused about', 'i don\'t understand'), [1]),
-    ]
+    # Heuristic rules to determine references, matched by the compiled pattern registry.
+    # Matching needs no storage, so the database is only used when messages are requested.
+    relative_indices = reference_patterns.resolve(text)
+    response = {'relative_indices': relative_indices}
+
+    if data.get('include_messages') and relative_indices:
+        response['messages'] = get_referenced_messages(session_id, relative_indices)
+
+    return jsonify(response), 200
+
+# Route to report embedding cache hit and miss counters
+@app.route('/embedding_cache/stats', methods=['GET'])
+def embedding_cache_stats():
+    return jsonify(embedding_cache.stats()), 200
+
+# Route to report how often each reference pattern fired
+@app.route('/reference_patterns/stats', methods=['GET'])
+def reference_patterns_stats():
+    return jsonify(reference_patterns.stats()), 200
 
-    threshold = 80  # Threshold for fuzzy matching (0-100)
+# Route to report long-term memory gating counters, escalation rate and agreement with the LLM
+@app.route('/ltm_gate/stats', methods=['GET'])
+def ltm_gate_stats():
+    return jsonify(long_term_gate.stats()), 200
 
-    for keywords, indices in patterns:
-        for keyword in keywords:
-            similarity = fuzz.partial_ratio(keyword, text_lower)
-            if similarity >= threshold:
-                relative_indices.extend(indices)
-                break  # No need to check other keywords in this pattern
+# Route to capture collapsed stacks of every thread for a flame graph, when PROFILER_ENABLED=1
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    if not PROFILER_ENABLED:
+        return jsonify({'error': 'Profiler is disabled'}), 404
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), 60.0)
+        interval = max(float(request.args.get('interval', 0.005)), 0.001)
+    except ValueError:
+        return jsonify({'error': 'seconds and interval must be numbers'}), 400
+    stacks = profiler.sample(seconds, interval)
+    if stacks is None:
+        return jsonify({'error': 'A profile is already being captured'}), 409
+    return Response(stacks, mimetype='text/plain')
 
-    # Remove duplicates and sort
-    relative_indices = sorted(set(relative_indices))
+# Counters kept by the caches, the gate and the pattern registry, exported on /metrics
+register_stats('embedding_cache', embedding_cache.stats)
+register_stats('embedding_coalescer', embedding_coalescer.stats)
+register_stats('session_cache', session_cache.stats)
+register_stats('ltm_gate', long_term_gate.stats)
+register_stats('reference_patterns', reference_patterns.stats)
+register_stats('openai_embeddings', embeddings_calls.stats)
+register_stats('openai_chat', chat_calls.stats)
 
-    return jsonify({'relative_indices': relative_indices}), 200
+# Finish background work before the process exits: process queued long-term memories,
+# persist ANN indexes that have unsaved vectors and release the thread pools and clients
+def shutdown(timeout=config.SHUTDOWN_DRAIN_TIMEOUT):
+    if not long_term_queue.drain(timeout):
+        abandoned = long_term_queue.abandon('Worker stopped before the text was processed')
+        logging.getLogger(__name__).warning(
+            "Long-term memory queue not drained within %s seconds of shutdown; %d texts marked failed", timeout, abandoned
+        )
+    session_ann.save_all()
+    long_term_ann.save_all()
+    io_executor.shutdown(wait=False)
+    search_executor.shutdown(wait=False)
+    mongo_client.close()
 
-# Run the Flask app
+# Run the Flask development server; use gunicorn -c gunicorn.conf.py wsgi:app in production
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port='8888', debug=True)
+    app.run(host=config.HOST, port=config.PORT, debug=config.DEBUG)
@@ -1,20 +1,35 @@
 from flask import Flask, request, jsonify
 import pandas as pd
 import os
+import logging
+import math
 import openai
 import uuid
 import pymongo
 from pymongo import MongoClient
 from datetime import datetime
+from mongo_indexes import provision_indexes
+from reference_matcher import PatternRegistry
+from sequence import allocate_indices
+from embedding_cache import make_embedding_cache
+from embedding_provider import make_embedding_provider
+from openai_client import OutboundUnavailable, chat_policy, embeddings_policy, make_openai_client
+from embedding_codec import decode_embedding, encode_embedding
+from scoring import rank_texts, stack_embeddings
+import config
 
 # Initialize the Flask app
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 # Set OpenAI API key (ensure the key is stored as an environment variable)
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-from openai import OpenAI
-client = OpenAI()
+# Shared OpenAI client with a bounded connection pool; calls go through per-kind
+# policies with rate limiting, jittered retries and a circuit breaker
+client = make_openai_client()
+embeddings_calls = embeddings_policy()
+chat_calls = chat_policy()
 
 # Set up MongoDB client
 MONGO_URI = os.getenv("MONGO_URI")  # Ensure your MongoDB URI is set in the environment variables
@@ -22,28 +37,38 @@ mongo_client = MongoClient(MONGO_URI)
 db = mongo_client['mydatabase']  # Replace 'mydatabase' with your database name
 embeddings_collection = db['embeddings']  # Collection to store session-based embeddings
 long_term_memory_collection = db['long_term_memory']  # Collection to store long-term memory embeddings
+session_counters_collection = db['session_counters']  # Collection to store the last message index per session
 
-# Embedding creation function
+# Create the session and long-term memory indexes and check the hot query plans
+provision_indexes(db)
+
+# Reference patterns loaded from REFERENCE_PATTERNS_PATH, matched as plain substrings in this app
+reference_patterns = PatternRegistry(fuzzy=False)
+embedding_cache_collection = db['embedding_cache']  # Collection to store cached embeddings by text hash
+
+# Embedding backend selected by EMBEDDING_PROVIDER: the OpenAI API or a local stand-in for benchmarks
+embedding_provider = make_embedding_provider(client, policy=embeddings_calls)
+
+# Cache of embeddings keyed by model and normalized text
+embedding_cache = make_embedding_cache(embedding_provider.model, embedding_cache_collection)
+
+# Embedding creation function, served from the embedding cache when possible
 def create_embedding(text):
-    response = client.embeddings.create(
-        input=text,
-        model="text-embedding-3-small"
-    )
-    return response.data[0].embedding
+    return embedding_cache.get_or_create(text, embed_text)
+
+# Uncached call to the embedding backend
+def embed_text(text):
+    return embedding_provider.embed(text)
 
 # Add a new text and its embedding to MongoDB (session-based)
 def add_text_to_db(session_id, text):
     text_embedding = create_embedding(text)
-    # Get the highest index in the session
-    last_doc = embeddings_collection.find({'session_id': session_id}).sort('index', -1).limit(1)
-    last_index = 0
-    for doc in last_doc:
-        last_index = doc.get('index', 0)
-    index = last_index + 1
+    # Atomically reserve the next index in the session
+    index = allocate_indices(session_counters_collection, embeddings_collection, session_id)
     document = {
         'session_id': session_id,
         'text': text,
-        'embedding': text_embedding,
+        'embedding': encode_embedding(text_embedding),
         'timestamp': datetime.utcnow(),
         'index': index
     }
@@ -61,29 +86,15 @@ def texts_ranked_by_relatedness(query, session_id, top_n=100):
     embeddings = []
     for doc in cursor:
         texts.append(doc['text'])
-        embeddings.append(doc['embedding'])
+        embeddings.append(decode_embedding(doc['embedding']))
     
-    # Compute similarities
-    from scipy import spatial
-    relatedness_scores = [1 - spatial.distance.cosine(query_embedding, emb) for emb in embeddings]
-    
-    # Combine texts and scores
-    texts_and_scores = list(zip(texts, relatedness_scores))
-    
-    # Sort by scores
-    texts_and_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Get top N
-    top_texts_and_scores = texts_and_scores[:top_n]
-    
-    top_texts = [t[0] for t in top_texts_and_scores]
-    top_scores = [t[1] for t in top_texts_and_scores]
-    
-    return top_texts, top_scores
+    # Score every document with one matrix-vector product
+    return rank_texts(query_embedding, texts, stack_embeddings(embeddings), top_n)
 
 # Function to decide whether to store text in long-term memory
 def should_store_in_long_term_memory(prompt):
-    completion = client.chat.completions.create(
+    completion = chat_calls.call(
+      client.chat.completions.create,
       model="gpt-4o",
       messages=[
         {"role": "system", "content": "You are a long term memory boolean program"},
@@ -91,7 +102,7 @@ def should_store_in_long_term_memory(prompt):
       ]
     )
     response = completion.choices[0].message.content.strip()
-    print("The response of the Boolean long term memory is ", response)
+    logger.debug("Long-term memory gate answered %r", response)
     return response
 
 # Add a new text to long-term memory
@@ -100,7 +111,7 @@ def add_text_to_long_term_memory(uuid, text):
     document = {
         'uuid': uuid,
         'text': text,
-        'embedding': text_embedding,
+        'embedding': encode_embedding(text_embedding),
         'timestamp': datetime.utcnow()
     }
     long_term_memory_collection.insert_one(document)
@@ -117,28 +128,20 @@ def texts_ranked_by_relatedness_long_term(query, uuid, top_n=100):
     embeddings = []
     for doc in cursor:
         texts.append(doc['text'])
-        embeddings.append(doc['embedding'])
-    
-    # Compute similarities
-    from scipy import spatial
-    relatedness_scores = [1 - spatial.distance.cosine(query_embedding, emb) for emb in embeddings]
+        embeddings.append(decode_embedding(doc['embedding']))
     
-    # Combine texts and scores
-    texts_and_scores = list(zip(texts, relatedness_scores))
-    
-    # Sort by scores
-    texts_and_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Get top N
-    top_texts_and_scores = texts_and_scores[:top_n]
-    
-    top_texts = [t[0] for t in top_texts_and_scores]
-    top_scores = [t[1] for t in top_texts_and_scores]
-    
-    return top_texts, top_scores
+    # Score every document with one matrix-vector product
+    return rank_texts(query_embedding, texts, stack_embeddings(embeddings), top_n)
 
 # Flask routes
 
+# OpenAI calls rejected by the rate limiter or an open circuit answer 503 with Retry-After
+@app.errorhandler(OutboundUnavailable)
+def outbound_unavailable(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
 # Route to add text for a specific session
 @app.route('/add_text', methods=['POST'])
 def add_text():
@@ -256,37 +259,16 @@ def resolve_references():
     if not text:
         return jsonify({'error': 'Text is required'}), 400
 
-    # Get the current index for the session
-    last_doc = embeddings_collection.find({'session_id': session_id}).sort('index', -1).limit(1)
-    last_index = 0
-    for doc in last_doc:
-        last_index = doc.get('index', 0)
-    current_index = last_index + 1  # Index of the current message
-
-    # Lowercase the current message
-    text_lower = text.lower()
-
-    # Heuristic rules to determine references
-    relative_indices = []
-
-    # Define patterns and corresponding relative indices
-    patterns = {
-        ('it', 'this', 'that'): [1],
-        ('they', 'them', 'those', 'these'): [1, 2],
-        ('which one',): [1, 2],
-        ('what was my last message',): [1],
-        ('tell me more about',): [1]
-    }
-
-    for keywords, indices in patterns.items():
-        if any(keyword in text_lower for keyword in keywords):
-            relative_indices.extend(indices)
-
-    # Remove duplicates and sort
-    relative_indices = sorted(set(relative_indices))
+    # Heuristic rules to determine references, matched verbatim against the shared pattern registry
+    relative_indices = reference_patterns.resolve(text)
 
     return jsonify({'relative_indices': relative_indices}), 200
 
+# Route to report how often each reference pattern fired
+@app.route('/reference_patterns/stats', methods=['GET'])
+def reference_patterns_stats():
+    return jsonify(reference_patterns.stats()), 200
+
 # Run the Flask app
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port='8888', debug=True)
+    app.run(host=config.HOST, port=config.PORT, debug=config.DEBUG)
@@ -1,21 +1,31 @@
 from flask import Flask, request, jsonify
 import pandas as pd
-from scipy import spatial
 import os
+import logging
+import math
 import openai
 import uuid
 import pymongo
 from pymongo import MongoClient
 from datetime import datetime
+from embedding_cache import make_embedding_cache
+from embedding_codec import decode_embedding, encode_embedding
+from scoring import rank_texts, stack_embeddings
+from openai_client import OutboundUnavailable, chat_policy, embeddings_policy, make_openai_client
+import config
 
 # Initialize the Flask app
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 # Set OpenAI API key (ensure the key is stored as an environment variable)
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-from openai import OpenAI
-client = OpenAI()
+# Shared OpenAI client with a bounded connection pool; calls go through per-kind
+# policies with rate limiting, jittered retries and a circuit breaker
+client = make_openai_client()
+embeddings_calls = embeddings_policy()
+chat_calls = chat_policy()
 
 # Set up MongoDB client
 MONGO_URI = os.getenv("MONGO_URI")  # Ensure your MongoDB URI is set in the environment variables
@@ -23,10 +33,19 @@ mongo_client = MongoClient(MONGO_URI)
 db = mongo_client['mydatabase']  # Replace 'mydatabase' with your database name
 embeddings_collection = db['embeddings']  # Collection to store session-based embeddings
 long_term_memory_collection = db['long_term_memory']  # Collection to store long-term memory embeddings
+embedding_cache_collection = db['embedding_cache']  # Collection to store cached embeddings by text hash
 
-# Embedding creation function
+# Cache of embeddings keyed by model and normalized text
+embedding_cache = make_embedding_cache("text-embedding-3-small", embedding_cache_collection)
+
+# Embedding creation function, served from the embedding cache when possible
 def create_embedding(text):
-    response = client.embeddings.create(
+    return embedding_cache.get_or_create(text, embed_text)
+
+# Uncached call to the embeddings API
+def embed_text(text):
+    response = embeddings_calls.call(
+        client.embeddings.create,
         input=text,
         model="text-embedding-3-small"
     )
@@ -38,7 +57,7 @@ def add_text_to_db(session_id, text):
     document = {
         'session_id': session_id,
         'text': text,
-        'embedding': text_embedding,
+        'embedding': encode_embedding(text_embedding),
         'timestamp': datetime.utcnow()
     }
     embeddings_collection.insert_one(document)
@@ -55,28 +74,15 @@ def texts_ranked_by_relatedness(query, session_id, top_n=100):
     embeddings = []
     for doc in cursor:
         texts.append(doc['text'])
-        embeddings.append(doc['embedding'])
-    
-    # Compute similarities
-    relatedness_scores = [1 - spatial.distance.cosine(query_embedding, emb) for emb in embeddings]
-    
-    # Combine texts and scores
-    texts_and_scores = list(zip(texts, relatedness_scores))
-    
-    # Sort by scores
-    texts_and_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Get top N
-    top_texts_and_scores = texts_and_scores[:top_n]
-    
-    top_texts = [t[0] for t in top_texts_and_scores]
-    top_scores = [t[1] for t in top_texts_and_scores]
+        embeddings.append(decode_embedding(doc['embedding']))
     
-    return top_texts, top_scores
+    # Score every document with one matrix-vector product
+    return rank_texts(query_embedding, texts, stack_embeddings(embeddings), top_n)
 
 # Function to decide whether to store text in long-term memory
 def should_store_in_long_term_memory(prompt):
-    completion = client.chat.completions.create(
+    completion = chat_calls.call(
+      client.chat.completions.create,
       model="gpt-4o",
       messages=[
         {"role": "system", "content": "You are a long term memory boolean program"},
@@ -84,7 +90,7 @@ def should_store_in_long_term_memory(prompt):
       ]
     )
     response = completion.choices[0].message.content.strip()
-    print("The response of the Boolean long term memory is ", response)
+    logger.debug("Long-term memory gate answered %r", response)
     return response
 
 # Add a new text to long-term memory
@@ -93,7 +99,7 @@ def add_text_to_long_term_memory(uuid, text):
     document = {
         'uuid': uuid,
         'text': text,
-        'embedding': text_embedding,
+        'embedding': encode_embedding(text_embedding),
         'timestamp': datetime.utcnow()
     }
     long_term_memory_collection.insert_one(document)
@@ -110,27 +116,20 @@ def texts_ranked_by_relatedness_long_term(query, uuid, top_n=100):
     embeddings = []
     for doc in cursor:
         texts.append(doc['text'])
-        embeddings.append(doc['embedding'])
+        embeddings.append(decode_embedding(doc['embedding']))
     
-    # Compute similarities
-    relatedness_scores = [1 - spatial.distance.cosine(query_embedding, emb) for emb in embeddings]
-    
-    # Combine texts and scores
-    texts_and_scores = list(zip(texts, relatedness_scores))
-    
-    # Sort by scores
-    texts_and_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Get top N
-    top_texts_and_scores = texts_and_scores[:top_n]
-    
-    top_texts = [t[0] for t in top_texts_and_scores]
-    top_scores = [t[1] for t in top_texts_and_scores]
-    
-    return top_texts, top_scores
+    # Score every document with one matrix-vector product
+    return rank_texts(query_embedding, texts, stack_embeddings(embeddings), top_n)
 
 # Flask routes
 
+# OpenAI calls rejected by the rate limiter or an open circuit answer 503 with Retry-After
+@app.errorhandler(OutboundUnavailable)
+def outbound_unavailable(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
 # Route to add text for a specific session
 @app.route('/add_text', methods=['POST'])
 def add_text():
@@ -237,4 +236,4 @@ def search_long_term_memory():
 
 # Run the Flask app
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port='8888', debug=True)
+    app.run(host=config.HOST, port=config.PORT, debug=config.DEBUG)
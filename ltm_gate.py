@@ -0,0 +1,144 @@
+import hashlib
+import os
+import random
+import re
+import threading
+from collections import OrderedDict
+
+from embedding_cache import normalize_text
+
+# Tiered store/no-store gate for long-term memory.
+# Cheap local rules settle the obvious cases: personal facts are stored, while
+# greetings, acknowledgements and impersonal questions are not. Only texts the
+# rules cannot settle are escalated to the LLM. Every decision is memoized by
+# text hash. A sample of the local decisions is also sent to the LLM in the
+# background, to measure how often the rules agree with it.
+LTM_GATE_CACHE_SIZE = int(os.getenv("LTM_GATE_CACHE_SIZE", 10000))
+LTM_GATE_AUDIT_RATE = float(os.getenv("LTM_GATE_AUDIT_RATE", 0.05))
+
+# Statements about the user that are always worth keeping. Each pattern has to be an
+# unambiguous self-description: a local store decision is permanent and only a sample
+# of them is ever checked. Phrasings that are just as often about the conversation
+# ("I love how you explained it", "I work in this file", "call me maybe") are left to
+# the LLM. ltm_gate_test.py lists examples on both sides.
+PROFESSIONS = (
+    "student|teacher|professor|nurse|doctor|dentist|pharmacist|engineer|developer|programmer|designer|"
+    "architect|lawyer|accountant|writer|journalist|artist|musician|photographer|chef|cook|farmer|pilot|"
+    "scientist|researcher|manager|consultant|freelancer|entrepreneur|retiree|mother|father|mom|dad|parent|"
+    "vegetarian|vegan"
+)
+STORE_RULES = [re.compile(pattern) for pattern in (
+    r"\bmy name is\b",
+    r"\bi(?:'m| am) (?:a|an) (?:[a-z]+ )?(?:" + PROFESSIONS + r")\b",
+    r"\bi(?:'m| am) (?:from|allergic to|vegetarian|vegan)\b",
+    # A place name, not "a world of pain" or "this file"
+    r"\bi (?:live|grew up) in (?!(?:a|an|the|this|that|these|those|my|your|it|here|there)\b)[a-z]+",
+    r"\bi was born (?:in|on)\b",
+    r"\bmy (?:favou?rite|birthday|wife|husband|partner|son|daughter|kids)\b",
+)]
+
+# Messages that carry nothing about the user
+SKIP_RULES = [re.compile(pattern) for pattern in (
+    r"^(?:hi|hello|hey|thanks|thank you|thx|ok|okay|cool|great|bye|goodbye|yes|no|sure|good (?:morning|night|evening))\W*$",
+)]
+
+QUESTION = re.compile(r"^(?:what|how|why|when|where|who|which|can|could|would|should|is|are|do|does|did|will|tell me)\b")
+FIRST_PERSON = re.compile(r"\b(?:i|i'm|i've|i'd|me|my|mine|myself)\b")
+
+
+# '1' to store, '0' to skip, or None when the rules cannot tell
+def classify_locally(text):
+    normalized = normalize_text(text).lower()
+    if any(rule.search(normalized) for rule in STORE_RULES):
+        return '1'
+    if any(rule.search(normalized) for rule in SKIP_RULES):
+        return '0'
+    if QUESTION.search(normalized) and not FIRST_PERSON.search(normalized):
+        return '0'
+    if len(normalized.split()) <= 2 and not FIRST_PERSON.search(normalized):
+        return '0'
+    return None
+
+
+class LongTermMemoryGate:
+    # llm_fn(text) returns the LLM's '0'/'1' answer for a text
+    def __init__(self, llm_fn, cache_size=LTM_GATE_CACHE_SIZE, audit_rate=LTM_GATE_AUDIT_RATE):
+        self.llm_fn = llm_fn
+        self.cache_size = cache_size
+        self.audit_rate = audit_rate
+        self._decisions = OrderedDict()
+        self._lock = threading.Lock()
+        self.counts = {
+            'decisions': 0,
+            'memo_hits': 0,
+            'local_store': 0,
+            'local_skip': 0,
+            'escalated': 0,
+            'audited': 0,
+            'audit_agreed': 0,
+        }
+
+    def _key(self, text):
+        return hashlib.sha256(normalize_text(text).lower().encode('utf-8')).hexdigest()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _remember(self, key, decision):
+        with self._lock:
+            self._decisions[key] = decision
+            self._decisions.move_to_end(key)
+            while len(self._decisions) > self.cache_size:
+                self._decisions.popitem(last=False)
+
+    # Ask the LLM about a locally decided text and record whether it agrees
+    def _audit(self, text, local_decision):
+        try:
+            llm_decision = self.llm_fn(text)
+        except Exception:
+            return
+        with self._lock:
+            self.counts['audited'] += 1
+            if (llm_decision == '1') == (local_decision == '1'):
+                self.counts['audit_agreed'] += 1
+
+    # Memoized or rule-based decision, or None when the text needs the LLM
+    def decide_locally(self, text):
+        key = self._key(text)
+        self._count('decisions')
+        with self._lock:
+            decision = self._decisions.get(key)
+            if decision is not None:
+                self._decisions.move_to_end(key)
+                self.counts['memo_hits'] += 1
+                return decision
+
+        decision = classify_locally(text)
+        if decision is not None:
+            self._count('local_store' if decision == '1' else 'local_skip')
+            if random.random() < self.audit_rate:
+                threading.Thread(target=self._audit, args=(text, decision), daemon=True).start()
+            self._remember(key, decision)
+        return decision
+
+    # Record an LLM decision for a text that decide_locally escalated
+    def record_escalation(self, text, decision):
+        self._count('escalated')
+        self._remember(self._key(text), decision)
+
+    # Memoized decision from the local rules, escalating to the LLM only when needed
+    def decide(self, text):
+        decision = self.decide_locally(text)
+        if decision is None:
+            decision = self.llm_fn(text)
+            self.record_escalation(text, decision)
+        return decision
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        evaluated = counts['decisions'] - counts['memo_hits']
+        counts['escalation_rate'] = counts['escalated'] / evaluated if evaluated else 0.0
+        counts['agreement_rate'] = counts['audit_agreed'] / counts['audited'] if counts['audited'] else None
+        return counts
@@ -0,0 +1,65 @@
+# Table check for the local store/no-store rules in ltm_gate.py.
+# Every text must get the expected local decision: '1' stored without the LLM,
+# '0' skipped, None escalated to the LLM. Chat that merely looks personal must
+# never be stored locally.
+#
+# Usage: python ltm_gate_test.py
+
+import sys
+
+from ltm_gate import classify_locally
+
+EXPECTED = [
+    # Unambiguous self-descriptions
+    ("My name is Ana", '1'),
+    ("I'm a software engineer", '1'),
+    ("I am a nurse", '1'),
+    ("I'm from Lisbon", '1'),
+    ("I am allergic to peanuts", '1'),
+    ("I live in London", '1'),
+    ("I grew up in Porto", '1'),
+    ("I was born in 1990", '1'),
+    ("My favourite band is Linkin Park", '1'),
+    ("my wife is called Maria", '1'),
+    # Nothing about the user
+    ("hello", '0'),
+    ("thanks!", '0'),
+    ("What is the capital of France?", '0'),
+    # Chat that looks personal but is about the conversation
+    ("I am a bit confused about that", None),
+    ("I'm a little tired today", None),
+    ("I like that idea", None),
+    ("I love it, thanks!", None),
+    ("i prefer the second option you gave", None),
+    ("Call me when it's done", None),
+    ("I hate to ask but can you repeat?", None),
+    ("I studied your answer and it still fails", None),
+    ("I work in this file a lot, can you fix line 3?", None),
+    ("I hate when this happens", None),
+    ("I love how you explained it", None),
+    ("I prefer the second approach you gave", None),
+    ("I enjoy reading your replies", None),
+    ("my email is broken, help", None),
+    ("call me maybe", None),
+    ("I'm married to this approach", None),
+    ("i live in a world of pain with this bug", None),
+    # Real preferences that the rules cannot tell apart from the above go to the LLM
+    ("I prefer shorter answers", None),
+]
+
+
+def run_check():
+    failures = []
+    for text, expected in EXPECTED:
+        actual = classify_locally(text)
+        if actual != expected:
+            failures.append((text, expected, actual))
+    for text, expected, actual in failures:
+        print(f"{text!r}: expected {expected!r}, got {actual!r}")
+    return not failures
+
+
+if __name__ == '__main__':
+    ok = run_check()
+    print("All local gate decisions as expected" if ok else "Local gate decisions differ from the table")
+    sys.exit(0 if ok else 1)
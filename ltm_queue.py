@@ -0,0 +1,246 @@
+import logging
+import os
+import queue
+import threading
+import time
+import uuid as uuid_lib
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+
+from batching import LazyThread, next_batch
+
+# Asynchronous ingestion for long-term memory.
+# Requests enqueue their texts and get a job id back. A background worker
+# gathers pending texts into batches and settles what it can through the local
+# gate. The remaining texts are classified together in one LLM call. Accepted
+# texts are embedded in one batched call and bulk-inserted per user.
+#
+# Job outcomes are kept in a job store. MongoJobStore shares them between worker
+# processes, so a status poll can reach any worker, and lets them expire through
+# a TTL index. MemoryJobStore keeps them in a bounded table of one process. The
+# queued texts themselves live in the memory of the worker that accepted them:
+# on shutdown the ones that could not be processed in time are marked failed, but
+# a worker that is killed outright leaves its jobs queued.
+LTM_QUEUE_BATCH_SIZE = int(os.getenv("LTM_QUEUE_BATCH_SIZE", 20))
+LTM_QUEUE_MAX_WAIT = float(os.getenv("LTM_QUEUE_MAX_WAIT", 0.5))
+LTM_QUEUE_MAX_JOBS = int(os.getenv("LTM_QUEUE_MAX_JOBS", 10000))
+
+logger = logging.getLogger(__name__)
+
+# Job outcomes of a single process, oldest dropped beyond max_jobs
+class MemoryJobStore:
+    def __init__(self, max_jobs=LTM_QUEUE_MAX_JOBS):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job['job_id']] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            view = {key: value for key, value in job.items() if key != 'remaining'}
+            view['results'] = [dict(result) for result in job['results']]
+            return view
+
+    def mark_running(self, job_ids):
+        with self._lock:
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job is not None and job['status'] == 'queued':
+                    job['status'] = 'running'
+
+    # outcomes is {job_id: [position, ...]}; all of them get the same stored value and error
+    def finish(self, outcomes, stored, error=None):
+        with self._lock:
+            for job_id, positions in outcomes.items():
+                job = self._jobs.get(job_id)
+                if job is None:
+                    continue
+                for position in positions:
+                    job['results'][position]['stored'] = stored
+                    if error is not None:
+                        job['results'][position]['error'] = error
+                if error is not None:
+                    job['error'] = error
+                job['remaining'] -= len(positions)
+                if job['remaining'] == 0:
+                    job['status'] = 'failed' if 'error' in job else 'done'
+                    job['finished_at'] = time.time()
+
+
+# Job outcomes in a MongoDB collection shared by every worker. Documents carry a
+# created_at date for the TTL index provisioned by mongo_indexes.
+class MongoJobStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def create(self, job):
+        document = {key: value for key, value in job.items() if key != 'job_id'}
+        document.update({'_id': job['job_id'], 'created_at': datetime.utcnow()})
+        self.collection.insert_one(document)
+
+    def get(self, job_id):
+        doc = self.collection.find_one({'_id': job_id}, {'remaining': 0, 'created_at': 0})
+        if doc is None:
+            return None
+        doc['job_id'] = doc.pop('_id')
+        return doc
+
+    def mark_running(self, job_ids):
+        self.collection.update_many({'_id': {'$in': list(job_ids)}, 'status': 'queued'}, {'$set': {'status': 'running'}})
+
+    def finish(self, outcomes, stored, error=None):
+        from pymongo import ReturnDocument
+        for job_id, positions in outcomes.items():
+            fields = {f'results.{position}.stored': stored for position in positions}
+            if error is not None:
+                fields.update({f'results.{position}.error': error for position in positions})
+                fields['error'] = error
+            doc = self.collection.find_one_and_update(
+                {'_id': job_id},
+                {'$set': fields, '$inc': {'remaining': -len(positions)}},
+                projection={'remaining': 1, 'error': 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if doc is not None and doc['remaining'] == 0:
+                self.collection.update_one(
+                    {'_id': job_id},
+                    {'$set': {'status': 'failed' if 'error' in doc else 'done', 'finished_at': time.time()}}
+                )
+
+
+
+
+class LongTermMemoryQueue:
+    # gate is a LongTermMemoryGate. classify_many(texts) returns one '0'/'1' per text.
+    # embed_many(texts) embeds the accepted texts of every user in the batch, and
+    # insert_many(uuid, texts, embeddings) stores those of one user. jobs is the job
+    # store, a MemoryJobStore unless given.
+    def __init__(self, gate, classify_many, embed_many, insert_many, batch_size=LTM_QUEUE_BATCH_SIZE,
+                 max_wait=LTM_QUEUE_MAX_WAIT, jobs=None):
+        self.gate = gate
+        self.classify_many = classify_many
+        self.embed_many = embed_many
+        self.insert_many = insert_many
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.jobs = jobs if jobs is not None else MemoryJobStore()
+        self._pending = queue.Queue()
+        self._worker = LazyThread(self._run, 'ltm-queue')
+
+    # Queue the texts of one user and return the job id
+    def submit(self, uuid, texts):
+        job_id = uuid_lib.uuid4().hex
+        job = {
+            'job_id': job_id,
+            'uuid': uuid,
+            'status': 'queued',
+            'submitted_at': time.time(),
+            'results': [{'text': text, 'stored': None} for text in texts],
+            'remaining': len(texts),
+        }
+        self.jobs.create(job)
+        self._worker.ensure_started()
+        for position, text in enumerate(texts):
+            self._pending.put((job_id, position, uuid, text))
+        return job_id
+
+    # Public view of a job, or None if it is unknown or has expired
+    def status(self, job_id):
+        return self.jobs.get(job_id)
+
+    # Wait up to timeout seconds for queued texts to be processed; False if some are left
+    def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self._pending.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    # Fail every text still queued without processing it, e.g. when the worker stops
+    # before the queue is drained; returns how many texts were abandoned
+    def abandon(self, error):
+        items = []
+        while True:
+            try:
+                items.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if items:
+            self._finish(items, None, error)
+            for _ in items:
+                self._pending.task_done()
+        return len(items)
+
+    def _run(self):
+        while True:
+            batch = next_batch(self._pending, self.batch_size, self.max_wait)
+            try:
+                self._process(batch)
+            except Exception as e:
+                # Raised before anything was stored or finished
+                logger.exception("Long-term memory batch failed")
+                self._finish(batch, None, str(e))
+            for _ in batch:
+                self._pending.task_done()
+
+    def _process(self, batch):
+        self._mark_running(batch)
+
+        # Settle what the memo and local rules can, then ask the LLM about the rest at once
+        decisions = [self.gate.decide_locally(text) for _, _, _, text in batch]
+        escalated = [position for position, decision in enumerate(decisions) if decision is None]
+        if escalated:
+            answers = self.classify_many([batch[position][3] for position in escalated])
+            for position, answer in zip(escalated, answers):
+                self.gate.record_escalation(batch[position][3], answer)
+                decisions[position] = answer
+
+        accepted = [item for item, decision in zip(batch, decisions) if decision == '1']
+        self._finish([item for item, decision in zip(batch, decisions) if decision != '1'], False)
+        if not accepted:
+            return
+
+        # One embedding call for every accepted text, then one bulk write per user. A
+        # failed write only fails the jobs of its own user, since the others are stored.
+        try:
+            embeddings = self.embed_many([text for _, _, _, text in accepted])
+        except Exception as e:
+            logger.exception("Embedding long-term memories failed")
+            self._finish(accepted, None, str(e))
+            return
+        by_user = defaultdict(list)
+        for item, embedding in zip(accepted, embeddings):
+            by_user[item[2]].append((item, embedding))
+        for uuid, rows in by_user.items():
+            items = [item for item, _ in rows]
+            try:
+                self.insert_many(uuid, [text for _, _, _, text in items], [embedding for _, embedding in rows])
+            except Exception as e:
+                logger.exception("Storing long-term memories for %s failed", uuid)
+                self._finish(items, None, str(e))
+            else:
+                self._finish(items, True)
+
+    def _mark_running(self, batch):
+        self.jobs.mark_running({job_id for job_id, _, _, _ in batch})
+
+    # Record the outcome of queued texts; stored is True, False or None when unknown
+    def _finish(self, items, stored, error=None):
+        if not items:
+            return
+        outcomes = defaultdict(list)
+        for job_id, position, _, _ in items:
+            outcomes[job_id].append(position)
+        try:
+            self.jobs.finish(outcomes, stored, error)
+        except Exception:
+            logger.exception("Recording long-term memory job outcomes failed")
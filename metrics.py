@@ -0,0 +1,320 @@
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process metrics in the Prometheus text format.
+# Counters, gauges and histograms are kept per label set behind one lock each.
+# stage() times a step of a request (embedding, Mongo reads, decoding, scoring,
+# serialization) into stage_duration_seconds. instrument_flask() adds per-endpoint
+# request latency, in-flight gauges and a /metrics route. Existing stats() methods
+# (caches, gate, pattern registry) are exported as gauges through register_stats().
+#
+# Every sample carries a worker label (the process id). Behind gunicorn each worker
+# keeps its own registry and a scrape reaches only one of them; with METRICS_DIR set
+# to a directory shared by the workers, each worker writes a snapshot there at most
+# every METRICS_FLUSH_INTERVAL seconds and /metrics answers with all of them.
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 1))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    # (name, kind, help, sample lines), with the extra labels put first on every sample
+    def collect(self, extra=()):
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = []
+        for key, value in items:
+            lines.extend(self._render_value(extra + key, value))
+        return self.name, self.kind, self.help, lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    # Values are [count per bucket, +Inf overflow included], sum, count
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][position] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._stats = []
+        self._flushed_at = -math.inf
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    # Export the numbers of a stats() dict as gauges named prefix_key; one level of
+    # nested dicts becomes a gauge labelled by name
+    def register_stats(self, prefix, stats_fn):
+        with self._lock:
+            self._stats.append((prefix, stats_fn))
+
+    def _collect_stats(self, prefix, stats, extra):
+        families = []
+        for key, value in sorted(stats.items()):
+            name = f"{prefix}_{key}"
+            if isinstance(value, dict):
+                samples = [(sub, v) for sub, v in sorted(value.items()) if _is_number(v)]
+                if samples:
+                    lines = [f"{name}{_format_labels(extra + (('name', sub),))} {_format_value(v)}" for sub, v in samples]
+                    families.append((name, 'gauge', None, lines))
+            elif _is_number(value):
+                families.append((name, 'gauge', None, [f"{name}{_format_labels(extra)} {_format_value(value)}"]))
+        return families
+
+    # Metric families of this process, each sample labelled with its worker
+    def collect(self):
+        with self._lock:
+            metrics = list(self._metrics)
+            stats = list(self._stats)
+        extra = (('worker', str(os.getpid())),)
+        families = [metric.collect(extra) for metric in metrics]
+        for prefix, stats_fn in stats:
+            try:
+                families.extend(self._collect_stats(prefix, stats_fn(), extra))
+            except Exception:
+                # A failing stats source must not take the whole endpoint down
+                continue
+        return families
+
+    # Text exposition of this process, or of every worker that wrote to directory
+    def render(self, directory=METRICS_DIR):
+        families = self.collect()
+        if directory:
+            families += _read_snapshots(directory)
+        merged = {}
+        for name, kind, help, lines in families:
+            entry = merged.setdefault(name, [kind, help, []])
+            entry[1] = entry[1] or help
+            entry[2].extend(lines)
+        out = []
+        for name, (kind, help, lines) in merged.items():
+            if help is not None:
+                out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return '\n'.join(out) + '\n'
+
+    # Write this process's families to directory, at most once per interval
+    def flush(self, directory=METRICS_DIR, interval=METRICS_FLUSH_INTERVAL):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._flushed_at < interval:
+                return
+            self._flushed_at = now
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"worker-{os.getpid()}.json")
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.collect(), f)
+        os.replace(tmp, path)
+
+
+# Families written by the other live workers; files of exited workers are removed
+def _read_snapshots(directory):
+    families = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return families
+    for name in names:
+        pid = name[len('worker-'):-len('.json')]
+        if not (name.startswith('worker-') and name.endswith('.json') and pid.isdigit()):
+            continue
+        pid = int(pid)
+        if pid == os.getpid():
+            continue
+        path = os.path.join(directory, name)
+        if not _is_alive(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                families.extend(tuple(family) for family in json.load(f))
+        except (OSError, ValueError):
+            # Being replaced by its worker; it is read again on the next scrape
+            continue
+    return families
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists, but belongs to another user
+        return True
+    return True
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+def register_stats(prefix, stats_fn):
+    REGISTRY.register_stats(prefix, stats_fn)
+
+
+STAGE_SECONDS = histogram('stage_duration_seconds', 'Time spent in each step of request handling', ('stage',))
+REQUEST_SECONDS = histogram('http_request_duration_seconds', 'Request latency by endpoint', ('endpoint', 'method', 'status'))
+REQUESTS_IN_FLIGHT = gauge('http_requests_in_flight', 'Requests being handled by endpoint', ('endpoint',))
+
+
+# Time a block of work as one stage
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+# Per-endpoint latency histograms, in-flight gauges and a /metrics route for a Flask app
+def instrument_flask(app, path='/metrics'):
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUESTS_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+    @app.after_request
+    def _record_request(response):
+        if 'metrics_start' in g:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - g.metrics_start,
+                endpoint=g.metrics_endpoint, method=request.method, status=str(response.status_code)
+            )
+        if METRICS_DIR:
+            try:
+                REGISTRY.flush()
+            except OSError:
+                # Metrics must not fail the request; the next one tries again
+                pass
+        return response
+
+    # Runs for failed requests too, which after_request does not see
+    @app.teardown_request
+    def _finish_request(exc):
+        if 'metrics_start' in g:
+            REQUESTS_IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
+
+    @app.route(path, methods=['GET'])
+    def metrics_endpoint():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    return app
@@ -0,0 +1,90 @@
+# Rewrite stored embeddings into another storage format (see embedding_codec.py).
+#
+# Usage:
+#   python migrate_embeddings.py --collection embeddings --to float32
+#   python migrate_embeddings.py --collection long_term_memory --to float16 --dry-run
+#   python migrate_embeddings.py --collection embeddings --to list   (roll back)
+#   python migrate_embeddings.py --collection long_term_memory --quantize int8
+#
+# Documents already in the target format are skipped, so the migration can be
+# stopped and resumed. The apps read every format, so it can run while they serve.
+# --quantize adds the compact search codes used by LTM_QUANTIZATION (see quantization.py)
+# to documents that do not have them yet.
+
+import argparse
+import os
+
+from pymongo import MongoClient, UpdateOne
+
+from embedding_codec import decode_embedding, encode_embedding
+from quantization import decode_codes, encode_codes
+
+
+def migrate(collection, target, batch_size=500, dry_run=False):
+    # Compare formats client-side, since $binarySubtype is not available on every server
+    cursor = collection.find({'embedding': {'$exists': True}}, {'embedding': 1}).batch_size(batch_size)
+    operations = []
+    migrated = 0
+    scanned = 0
+    for doc in cursor:
+        scanned += 1
+        value = doc['embedding']
+        encoded = encode_embedding(decode_embedding(value), target)
+        if type(encoded) is type(value) and getattr(encoded, 'subtype', None) == getattr(value, 'subtype', None):
+            continue
+        operations.append(UpdateOne({'_id': doc['_id']}, {'$set': {'embedding': encoded}}))
+        if len(operations) >= batch_size:
+            migrated += len(operations)
+            if not dry_run:
+                collection.bulk_write(operations, ordered=False)
+            operations = []
+            print(f"Migrated {migrated} of {scanned} scanned documents")
+    if operations:
+        migrated += len(operations)
+        if not dry_run:
+            collection.bulk_write(operations, ordered=False)
+    return scanned, migrated
+
+
+def backfill_codes(collection, mode, batch_size=500, dry_run=False):
+    cursor = collection.find({'embedding': {'$exists': True}}, {'embedding': 1, 'embedding_q': 1}).batch_size(batch_size)
+    operations = []
+    coded = 0
+    scanned = 0
+    for doc in cursor:
+        scanned += 1
+        if decode_codes(doc, mode) is not None:
+            continue
+        operations.append(UpdateOne({'_id': doc['_id']}, {'$set': encode_codes(decode_embedding(doc['embedding']), mode)}))
+        if len(operations) >= batch_size:
+            coded += len(operations)
+            if not dry_run:
+                collection.bulk_write(operations, ordered=False)
+            operations = []
+            print(f"Coded {coded} of {scanned} scanned documents")
+    if operations:
+        coded += len(operations)
+        if not dry_run:
+            collection.bulk_write(operations, ordered=False)
+    return scanned, coded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert stored embeddings between storage formats')
+    parser.add_argument('--collection', default='embeddings', help='embeddings, long_term_memory or embedding_cache')
+    parser.add_argument('--to', dest='target', default='float32', choices=['list', 'float32', 'float16'])
+    parser.add_argument('--quantize', choices=['int8', 'float16'], help='Add compact search codes instead of converting embeddings')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--dry-run', action='store_true', help='Count documents to convert without writing')
+    args = parser.parse_args()
+
+    mongo_client = MongoClient(os.getenv("MONGO_URI"))
+    db = mongo_client['mydatabase']
+    if args.quantize:
+        scanned, coded = backfill_codes(db[args.collection], args.quantize, args.batch_size, args.dry_run)
+        action = 'Would code' if args.dry_run else 'Coded'
+        print(f"{action} {coded} of {scanned} documents in {args.collection} as {args.quantize}")
+    else:
+        scanned, migrated = migrate(db[args.collection], args.target, args.batch_size, args.dry_run)
+        action = 'Would convert' if args.dry_run else 'Converted'
+        print(f"{action} {migrated} of {scanned} documents in {args.collection} to {args.target}")
@@ -0,0 +1,136 @@
+import logging
+import os
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+# Index provisioning for the session and long-term memory collections.
+# ensure_indexes() is run at app startup and is a no-op when the indexes exist.
+# check_query_plans() explains the hot queries and logs a warning for any that
+# would still scan the whole collection.
+#
+# Usage: python mongo_indexes.py   (create the indexes and print the plan check)
+
+logger = logging.getLogger(__name__)
+
+LTM_JOB_TTL = int(os.getenv("LTM_JOB_TTL", 24 * 60 * 60))
+
+INDEXES = {
+    'embeddings': [
+        # Session fetches, the last-index lookup and index-range queries (scanned in either direction)
+        ([('session_id', ASCENDING), ('index', DESCENDING)], {'name': 'session_id_index'}),
+        # Keeps two messages from sharing an index within a session. Partial, because the
+        # older apps write to the same collection without an index field, and a missing
+        # key would be indexed as a duplicate null.
+        ([('session_id', ASCENDING), ('index', ASCENDING)], {
+            'name': 'session_id_index_unique', 'unique': True,
+            'partialFilterExpression': {'index': {'$exists': True}}
+        }),
+        # Time-window searches
+        ([('session_id', ASCENDING), ('timestamp', ASCENDING)], {'name': 'session_id_timestamp'}),
+    ],
+    'long_term_memory': [
+        # Per-user fetches and counts, in insertion order
+        ([('uuid', ASCENDING), ('timestamp', ASCENDING)], {'name': 'uuid_timestamp'}),
+        # ANN index catch-up and rebuilds read a user's memories in _id order
+        ([('uuid', ASCENDING), ('_id', ASCENDING)], {'name': 'uuid_id'}),
+    ],
+    'long_term_memory_jobs': [
+        # Queued job outcomes expire LTM_JOB_TTL seconds after submission
+        ([('created_at', ASCENDING)], {'name': 'created_at_ttl', 'expireAfterSeconds': LTM_JOB_TTL}),
+    ],
+}
+
+# Hot queries as (collection, filter, sort), with placeholder values
+HOT_QUERIES = [
+    ('embeddings', {'session_id': '__plan_check__'}, None),
+    ('embeddings', {'session_id': '__plan_check__'}, [('index', -1)]),
+    ('embeddings', {'session_id': '__plan_check__', 'index': {'$gt': 0}}, [('index', 1)]),
+    ('embeddings', {'session_id': '__plan_check__', 'timestamp': {'$gte': datetime(1970, 1, 1)}}, None),
+    ('long_term_memory', {'uuid': '__plan_check__'}, None),
+    ('long_term_memory', {'uuid': '__plan_check__', '_id': {'$gt': ObjectId('000000000000000000000000')}}, [('_id', 1)]),
+]
+
+
+# Whether an existing index (as listed by index_information) matches a definition above
+def _same_definition(existing, keys, options):
+    return (
+        [tuple(key) for key in existing['key']] == keys
+        and bool(existing.get('unique')) == bool(options.get('unique'))
+        and existing.get('partialFilterExpression') == options.get('partialFilterExpression')
+        and existing.get('expireAfterSeconds') == options.get('expireAfterSeconds')
+    )
+
+
+def ensure_indexes(db):
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        for keys, options in indexes:
+            current = existing.get(options['name'])
+            if current is not None and not _same_definition(current, keys, options):
+                logger.warning("Index %s on %s has an outdated definition; rebuilding it", options['name'], collection_name)
+                collection.drop_index(options['name'])
+            try:
+                collection.create_index(keys, **options)
+            except OperationFailure as e:
+                if not options.get('unique'):
+                    raise
+                # Sessions written before the atomic index counter can hold duplicate
+                # indices; the lookups are still served by session_id_index
+                logger.warning("Could not create unique index %s on %s: %s", options['name'], collection_name, e)
+
+
+# Every stage name in an explain plan, including nested input stages
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+# Explain the hot queries and warn about those that are not served by an index
+def check_query_plans(db):
+    uncovered = []
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+        except (OperationFailure, KeyError) as e:
+            logger.warning("Could not explain query on %s: %s", collection_name, e)
+            continue
+        stages = set(_plan_stages(winning_plan))
+        if 'COLLSCAN' in stages or 'SORT' in stages:
+            logger.warning("Query %s on %s (sort %s) is not index-covered: %s", query, collection_name, sort, sorted(stages))
+            uncovered.append((collection_name, query, sort))
+    return uncovered
+
+
+# Startup hook used by the Flask apps; MONGO_ENSURE_INDEXES=0 turns it off
+def provision_indexes(db):
+    if os.getenv("MONGO_ENSURE_INDEXES", "1") == "0":
+        return
+    try:
+        ensure_indexes(db)
+        check_query_plans(db)
+    except Exception as e:
+        # Never keep the app from starting because of index management
+        logger.warning("Index provisioning failed: %s", e)
+
+
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    logging.basicConfig(level=logging.INFO)
+    mongo_client = MongoClient(os.getenv("MONGO_URI"))
+    db = mongo_client['mydatabase']
+    ensure_indexes(db)
+    uncovered = check_query_plans(db)
+    print("All hot queries are index-covered" if not uncovered else f"{len(uncovered)} hot queries are not index-covered")
@@ -0,0 +1,230 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+import openai
+from openai import OpenAI
+
+# Outbound layer for OpenAI calls.
+# One client per process, with a bounded keep-alive connection pool and per-call
+# timeouts. Each kind of call (embeddings, chat) goes through its own policy:
+#   - a token bucket matched to the quota, which waits briefly for a token and then
+#     fails fast instead of queueing without bound,
+#   - jittered exponential backoff on 429, 5xx, timeouts and connection errors,
+#     honouring Retry-After,
+#   - a circuit breaker that opens after consecutive failures and rejects calls
+#     until a trial call succeeds, so worker threads are not tied up by an outage.
+# Rates are per process; divide the account quota by the number of workers.
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 64))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", 32))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", 30))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", 5))
+OPENAI_POOL_TIMEOUT = float(os.getenv("OPENAI_POOL_TIMEOUT", 5))
+OPENAI_EMBED_TIMEOUT = float(os.getenv("OPENAI_EMBED_TIMEOUT", 15))
+OPENAI_CHAT_TIMEOUT = float(os.getenv("OPENAI_CHAT_TIMEOUT", 30))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 3))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", 0.5))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", 8))
+OPENAI_EMBED_RPM = float(os.getenv("OPENAI_EMBED_RPM", 3000))
+OPENAI_CHAT_RPM = float(os.getenv("OPENAI_CHAT_RPM", 500))
+OPENAI_RATE_WAIT = float(os.getenv("OPENAI_RATE_WAIT", 5))
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", 5))
+OPENAI_BREAKER_RESET = float(os.getenv("OPENAI_BREAKER_RESET", 30))
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+# Raised instead of calling the API when the call cannot be made now; retry_after is in seconds
+class OutboundUnavailable(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Seconds until a token is available, taking it now if there is one
+    def _reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    # Take a token, waiting at most max_wait seconds; False if none came in time
+    def acquire(self, max_wait):
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._reserve()
+            if wait == 0.0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    # Seconds to wait before calling, or 0 when the call may go ahead.
+    # Half-open lets a single trial call through.
+    def before_call(self):
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return 0.0
+            if state == 'half_open' and not self.trial_running:
+                self.trial_running = True
+                return 0.0
+            return max(self.opened_at + self.reset_timeout - time.monotonic(), 1.0)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    # Give back a trial slot that was granted but not used for a call
+    def cancel_trial(self):
+        with self._lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial_running:
+                    logger.warning("OpenAI circuit opened after %d consecutive failures", self.failures)
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class CallPolicy:
+    def __init__(self, name, rate_per_minute, timeout, max_retries=OPENAI_MAX_RETRIES,
+                 backoff_base=OPENAI_BACKOFF_BASE, backoff_max=OPENAI_BACKOFF_MAX, rate_wait=OPENAI_RATE_WAIT,
+                 breaker_failures=OPENAI_BREAKER_FAILURES, breaker_reset=OPENAI_BREAKER_RESET):
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_wait = rate_wait
+        self.bucket = TokenBucket(rate_per_minute)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self._lock = threading.Lock()
+        self.counts = {'calls': 0, 'retries': 0, 'failures': 0, 'rate_limited': 0, 'rejected_open': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    # Full jitter: uniform between 0 and the capped exponential delay, at least Retry-After
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    # Call fn(*args, timeout=..., **kwargs) under the rate limit, retry and breaker rules
+    def call(self, fn, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            wait = self.breaker.before_call()
+            if wait:
+                self._count('rejected_open')
+                raise OutboundUnavailable(f"OpenAI {self.name} circuit is open", wait)
+            if not self.bucket.acquire(self.rate_wait):
+                self.breaker.cancel_trial()
+                self._count('rate_limited')
+                raise OutboundUnavailable(f"OpenAI {self.name} rate limit reached", self.rate_wait)
+            self._count('calls')
+            try:
+                result = fn(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                time.sleep(self._backoff(attempt, e))
+                continue
+            except openai.APIStatusError:
+                # The API is up; it rejected this request
+                self.breaker.record_success()
+                raise
+            except Exception:
+                self.breaker.cancel_trial()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts['circuit_open'] = 0 if self.breaker.state == 'closed' else 1
+        return counts
+
+
+# Client with a bounded connection pool; retries are left to CallPolicy
+def make_openai_client():
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(OPENAI_CHAT_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT, pool=OPENAI_POOL_TIMEOUT)
+    )
+    return OpenAI(http_client=http_client, max_retries=0)
+
+
+def embeddings_policy():
+    return CallPolicy('embeddings', OPENAI_EMBED_RPM, OPENAI_EMBED_TIMEOUT)
+
+
+def chat_policy():
+    return CallPolicy('chat', OPENAI_CHAT_RPM, OPENAI_CHAT_TIMEOUT)
@@ -0,0 +1,40 @@
+import sys
+import threading
+import time
+from collections import Counter
+
+# On-demand sampling profiler for a running worker.
+# Every interval the stack of each thread is read from sys._current_frames() and
+# counted in the collapsed format ("outer;inner;leaf count" per line). That format
+# can be rendered as a flame graph by flamegraph.pl or speedscope. Only one capture
+# runs at a time.
+
+_capture_lock = threading.Lock()
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# Sample every thread but the profiler's own for the given time and return collapsed
+# stacks, or None when another capture is already running
+def sample(seconds, interval=0.005):
+    if not _capture_lock.acquire(blocking=False):
+        return None
+    try:
+        own_thread = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    stacks[_stack(frame)] += 1
+            time.sleep(interval)
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    finally:
+        _capture_lock.release()
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+from bson.binary import Binary
+
+from embedding_codec import SUBTYPE_FLOAT16
+from scoring import cosine_scores, top_n_indices
+
+# Compact codes for long-term memory search.
+# Each vector is unit-normalized and stored next to its full embedding either as
+# int8 codes with a per-vector scale or as float16. Searches score the compact
+# codes for every memory, keep a shortlist of the best candidates and rescore only
+# those at full precision, so the bulk of the scan moves 1-2 bytes per dimension.
+LTM_QUANTIZATION = os.getenv("LTM_QUANTIZATION", "none")  # none, int8 or float16
+LTM_RESCORE_FACTOR = int(os.getenv("LTM_RESCORE_FACTOR", 4))
+LTM_RESCORE_MIN = int(os.getenv("LTM_RESCORE_MIN", 50))
+
+# float16 codes share their Binary subtype with float16 embedding storage
+SUBTYPE_INT8 = 0x82
+
+MODES = {
+    'int8': (np.dtype('int8'), SUBTYPE_INT8),
+    'float16': (np.dtype('<f2'), SUBTYPE_FLOAT16),
+}
+
+
+def _unit_rows(matrix):
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+# Quantize the rows of a matrix, returning (codes, scales)
+def quantize(matrix, mode):
+    unit = _unit_rows(matrix)
+    if mode == 'float16':
+        return unit.astype(np.float16), np.ones(unit.shape[0], dtype=np.float32)
+    if mode == 'int8':
+        scales = np.abs(unit).max(axis=1) / 127.0
+        safe = np.where(scales > 0, scales, 1.0)[:, None]
+        codes = np.clip(np.rint(unit / safe), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Unknown quantization mode: {mode}")
+
+
+# Approximate cosine scores of every code row against the query
+def candidate_scores(codes, scales, query_embedding):
+    query = _unit_rows(query_embedding)[0]
+    return (codes.astype(np.float32) @ query) * scales
+
+
+# Number of candidates kept for full-precision rescoring
+def shortlist_size(top_n, n, factor=LTM_RESCORE_FACTOR, minimum=LTM_RESCORE_MIN):
+    return min(n, max(top_n * factor, minimum))
+
+
+# Positions of the candidates to rescore, best approximate score first
+def shortlist(codes, scales, query_embedding, top_n, factor=LTM_RESCORE_FACTOR, minimum=LTM_RESCORE_MIN):
+    scores = candidate_scores(codes, scales, query_embedding)
+    return top_n_indices(scores, shortlist_size(top_n, scores.shape[0], factor, minimum))
+
+
+# Exact search with the same shortlist-and-rescore path, for offline evaluation
+def search(matrix, codes, scales, query_embedding, top_n, factor=LTM_RESCORE_FACTOR, minimum=LTM_RESCORE_MIN):
+    candidates = shortlist(codes, scales, query_embedding, top_n, factor, minimum)
+    exact = cosine_scores(matrix[candidates], query_embedding)
+    return candidates[top_n_indices(exact, top_n)]
+
+
+# Document fields holding the compact code of one embedding
+def encode_codes(embedding, mode=None):
+    mode = mode or LTM_QUANTIZATION
+    dtype, subtype = MODES[mode]
+    codes, scales = quantize(embedding, mode)
+    return {
+        'embedding_q': Binary(codes[0].astype(dtype).tobytes(), subtype),
+        'embedding_scale': float(scales[0]),
+    }
+
+
+# Code vector and scale from a stored document, or None if it has no code in this mode
+def decode_codes(doc, mode=None):
+    mode = mode or LTM_QUANTIZATION
+    value = doc.get('embedding_q')
+    dtype, subtype = MODES[mode]
+    if not isinstance(value, Binary) or value.subtype != subtype:
+        return None
+    return np.frombuffer(value, dtype=dtype), doc.get('embedding_scale', 1.0)
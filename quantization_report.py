@@ -0,0 +1,79 @@
+# Recall@k of quantized long-term memory search against the exact path.
+#
+# Usage:
+#   python quantization_report.py --uuid your_user_id
+#   python quantization_report.py --synthetic 20000 --k 10
+#
+# A sample of memories is held out and used as queries against the rest, so no
+# embedding API calls are made. Each row reports the recall of the
+# shortlist-and-rescore search for one mode and rescore factor, the bytes the
+# candidate scan reads per vector and the mean search time.
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from embedding_codec import decode_embedding
+from quantization import quantize, search
+from scoring import cosine_scores, stack_embeddings, top_n_indices
+
+
+def load_long_term_matrix(uuid):
+    from pymongo import MongoClient
+    mongo_client = MongoClient(os.getenv("MONGO_URI"))
+    collection = mongo_client['mydatabase']['long_term_memory']
+    cursor = collection.find({'uuid': uuid}, {'embedding': 1})
+    return stack_embeddings([decode_embedding(doc['embedding']) for doc in cursor])
+
+
+# Clustered unit vectors, closer to real embeddings than uniform noise
+def synthetic_matrix(n, dim=1536, clusters=64, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    matrix = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def report(matrix, k, queries, factors, minimum, seed=0):
+    rng = np.random.default_rng(seed)
+    held_out = rng.choice(matrix.shape[0], size=min(queries, matrix.shape[0] // 10 or 1), replace=False)
+    mask = np.ones(matrix.shape[0], dtype=bool)
+    mask[held_out] = False
+    corpus = np.ascontiguousarray(matrix[mask])
+    query_rows = matrix[held_out]
+
+    start = time.perf_counter()
+    exact = [set(top_n_indices(cosine_scores(corpus, q), k).tolist()) for q in query_rows]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(query_rows)
+    print(f"{corpus.shape[0]} vectors, {len(query_rows)} queries, k={k}")
+    print(f"{'mode':<8} {'factor':>6} {'recall@k':>9} {'bytes/vec':>10} {'ms/query':>9}")
+    print(f"{'exact':<8} {'-':>6} {1.0:>9.4f} {corpus.shape[1] * 4:>10} {exact_ms:>9.2f}")
+
+    for mode in ('int8', 'float16'):
+        codes, scales = quantize(corpus, mode)
+        bytes_per_vector = codes.shape[1] * codes.dtype.itemsize + (4 if mode == 'int8' else 0)
+        for factor in factors:
+            start = time.perf_counter()
+            found = [set(search(corpus, codes, scales, q, k, factor, minimum).tolist()) for q in query_rows]
+            elapsed_ms = (time.perf_counter() - start) * 1000 / len(query_rows)
+            recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+            print(f"{mode:<8} {factor:>6} {recall:>9.4f} {bytes_per_vector:>10} {elapsed_ms:>9.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recall@k of quantized long-term memory search')
+    parser.add_argument('--uuid', help='Evaluate on the stored memories of this user')
+    parser.add_argument('--synthetic', type=int, default=10000, help='Number of synthetic vectors when no uuid is given')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--factors', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--min-shortlist', type=int, default=0, help='Lower bound on the shortlist size (LTM_RESCORE_MIN)')
+    args = parser.parse_args()
+
+    matrix = load_long_term_matrix(args.uuid) if args.uuid else synthetic_matrix(args.synthetic)
+    if matrix.shape[0] < 2:
+        print("Not enough vectors to evaluate")
+    else:
+        report(matrix, args.k, args.queries, args.factors, args.min_shortlist)
@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+try:
+    from rapidfuzz import fuzz as rapidfuzz_fuzz, process as rapidfuzz_process
+except ImportError:
+    rapidfuzz_fuzz = None
+    rapidfuzz_process = None
+
+# Reference resolution engine for /resolve_references.
+# Patterns live in a versioned JSON file (reference_patterns.json by default).
+# The pattern table is compiled once into an Aho-Corasick automaton, so a single
+# pass over the message finds every keyword that occurs verbatim (a partial_ratio
+# of 100). Only keywords of patterns that did not fire are then scored with the
+# same partial_ratio as before, in one batched rapidfuzz call with a score cutoff,
+# so the resulting relative_indices are unchanged.
+
+REFERENCE_PATTERNS_PATH = os.getenv(
+    "REFERENCE_PATTERNS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_patterns.json")
+)
+REFERENCE_PATTERNS_CHECK_INTERVAL = float(os.getenv("REFERENCE_PATTERNS_CHECK_INTERVAL", 2.0))
+REFERENCE_MATCH_CACHE_SIZE = int(os.getenv("REFERENCE_MATCH_CACHE_SIZE", 4096))
+
+logger = logging.getLogger(__name__)
+
+
+# Read a versioned pattern file into (version, patterns). Each pattern is a dict
+# with an id, its keywords, the relative indices it points to and a threshold,
+# which defaults to the file-wide threshold.
+def load_patterns(path=REFERENCE_PATTERNS_PATH):
+    with open(path) as f:
+        data = json.load(f)
+    default_threshold = data.get('threshold', 80)
+    patterns = []
+    seen = set()
+    for pattern in data['patterns']:
+        if pattern['id'] in seen:
+            raise ValueError(f"Duplicate pattern id: {pattern['id']}")
+        seen.add(pattern['id'])
+        keywords = [keyword.lower() for keyword in pattern['keywords']]
+        if not keywords or not all(keywords):
+            raise ValueError(f"Pattern {pattern['id']} needs non-empty keywords")
+        patterns.append({
+            'id': pattern['id'],
+            'keywords': keywords,
+            'relative_indices': [int(index) for index in pattern['relative_indices']],
+            'threshold': pattern.get('threshold', default_threshold),
+        })
+    return data.get('version'), patterns
+
+
+# Aho-Corasick automaton reporting which of a set of strings occur in a text
+class KeywordAutomaton:
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for keyword_id, keyword in enumerate(keywords):
+            self._insert(keyword, keyword_id)
+        self._link()
+
+    def _insert(self, keyword, keyword_id):
+        state = 0
+        for char in keyword:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].add(keyword_id)
+
+    # Breadth-first failure links, merging the outputs of suffix states
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] |= self.output[self.fail[child]]
+
+    # Ids of the keywords that occur in the text
+    def find(self, text):
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+
+class ReferenceMatcher:
+    # With fuzzy=False only verbatim keyword occurrences count, whatever the thresholds
+    def __init__(self, patterns, fuzzy=True):
+        self.patterns = patterns
+        self.fuzzy = fuzzy
+        self.keywords = []
+        self.keyword_patterns = []
+        for pattern_id, pattern in enumerate(self.patterns):
+            for keyword in pattern['keywords']:
+                self.keywords.append(keyword)
+                self.keyword_patterns.append(pattern_id)
+        self.automaton = KeywordAutomaton(self.keywords)
+
+    # Positions of the patterns that fire for the message
+    def matching_patterns(self, text):
+        text_lower = text.lower()
+        matched = {self.keyword_patterns[keyword_id] for keyword_id in self.automaton.find(text_lower)}
+        if self.fuzzy:
+            # A threshold of 100 or more only accepts verbatim matches, which the automaton already found
+            remaining = [
+                keyword_id for keyword_id, pattern_id in enumerate(self.keyword_patterns)
+                if pattern_id not in matched and self.patterns[pattern_id]['threshold'] < 100
+            ]
+            matched |= self._fuzzy_patterns(text_lower, remaining)
+        return matched
+
+    # Patterns with a keyword whose rounded partial_ratio reaches the pattern's threshold
+    def _fuzzy_patterns(self, text_lower, keyword_ids):
+        if not keyword_ids:
+            return set()
+        keywords = [self.keywords[keyword_id] for keyword_id in keyword_ids]
+        thresholds = [self.patterns[self.keyword_patterns[keyword_id]]['threshold'] for keyword_id in keyword_ids]
+        if rapidfuzz_process is not None:
+            scores = rapidfuzz_process.cdist(
+                keywords, [text_lower], scorer=rapidfuzz_fuzz.partial_ratio, score_cutoff=min(thresholds) - 0.5
+            )[:, 0]
+        else:
+            from thefuzz import fuzz
+            scores = [fuzz.partial_ratio(keyword, text_lower) for keyword in keywords]
+        return {
+            self.keyword_patterns[keyword_id]
+            for keyword_id, score, threshold in zip(keyword_ids, scores, thresholds)
+            if round(score) >= threshold
+        }
+
+    # Sorted relative indices referenced by the message
+    def resolve(self, text):
+        relative_indices = set()
+        for pattern_id in self.matching_patterns(text):
+            relative_indices.update(self.patterns[pattern_id]['relative_indices'])
+        return sorted(relative_indices)
+
+
+# Pattern file compiled into a matcher that is swapped in when the file changes.
+# Requests never rebuild anything: at most every check_interval seconds one of
+# them stats the file, and only a changed, valid file is compiled and swapped in.
+# Matching is a pure function of the message and the matcher, so recent results
+# are memoized per matcher.
+class PatternRegistry:
+    def __init__(self, path=REFERENCE_PATTERNS_PATH, fuzzy=True, check_interval=REFERENCE_PATTERNS_CHECK_INTERVAL,
+                 cache_size=REFERENCE_MATCH_CACHE_SIZE):
+        self.path = path
+        self.fuzzy = fuzzy
+        self.check_interval = check_interval
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._hits = Counter()
+        self._requests = 0
+        self._next_check = 0.0
+        self._mtime = None
+        self.version = None
+        self.matcher = None
+        self.reload()
+
+    # Compile the file and swap it in; a broken file keeps the current matcher
+    def reload(self):
+        mtime = os.stat(self.path).st_mtime
+        try:
+            version, patterns = load_patterns(self.path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if self.matcher is None:
+                raise
+            logger.error("Keeping reference patterns version %s, could not load %s: %s", self.version, self.path, e)
+            self._mtime = mtime
+            return False
+        matcher = ReferenceMatcher(patterns, fuzzy=self.fuzzy)
+        # Single reference assignment, so concurrent requests see either the old or the new matcher
+        self.matcher, self.version, self._mtime = matcher, version, mtime
+        with self._cache_lock:
+            self._cache.clear()
+        logger.info("Loaded reference patterns version %s (%d patterns)", version, len(patterns))
+        return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check or not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self.check_interval
+            if os.stat(self.path).st_mtime != self._mtime:
+                self.reload()
+        except OSError as e:
+            logger.error("Could not check reference patterns file %s: %s", self.path, e)
+        finally:
+            self._reload_lock.release()
+
+    # Sorted relative indices referenced by the message, counting which patterns fired
+    def resolve(self, text):
+        self._maybe_reload()
+        matcher = self.matcher
+        pattern_ids = self._matching_patterns(matcher, text)
+        relative_indices = set()
+        for pattern_id in pattern_ids:
+            relative_indices.update(matcher.patterns[pattern_id]['relative_indices'])
+        with self._stats_lock:
+            self._requests += 1
+            self._hits.update(matcher.patterns[pattern_id]['id'] for pattern_id in pattern_ids)
+        return sorted(relative_indices)
+
+    def _matching_patterns(self, matcher, text):
+        key = (id(matcher), text.lower())
+        with self._cache_lock:
+            pattern_ids = self._cache.get(key)
+            if pattern_ids is not None:
+                self._cache.move_to_end(key)
+                return pattern_ids
+        pattern_ids = frozenset(matcher.matching_patterns(text))
+        with self._cache_lock:
+            self._cache[key] = pattern_ids
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return pattern_ids
+
+    # Hits per pattern of the current version, so patterns that never fire can be pruned
+    def stats(self):
+        matcher = self.matcher
+        with self._stats_lock:
+            return {
+                'version': self.version,
+                'requests': self._requests,
+                'patterns': {pattern['id']: self._hits[pattern['id']] for pattern in matcher.patterns},
+            }
+
+
+# The per-request loop this engine replaces, kept as the reference for benchmarks
+def resolve_with_loop(text, patterns):
+    from thefuzz import fuzz
+    text_lower = text.lower()
+    relative_indices = []
+    for pattern in patterns:
+        for keyword in pattern['keywords']:
+            if fuzz.partial_ratio(keyword, text_lower) >= pattern['threshold']:
+                relative_indices.extend(pattern['relative_indices'])
+                break
+    return sorted(set(relative_indices))
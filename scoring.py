@@ -0,0 +1,82 @@
+import numpy as np
+
+# Vectorized cosine scoring shared by the session and long-term memory search paths.
+# Embeddings are stacked into one contiguous float32 matrix so a whole session is
+# scored with a single matrix-vector product instead of one scipy call per document.
+
+
+# Stack a list of embeddings into a contiguous (n, d) float32 matrix
+def stack_embeddings(embeddings):
+    if len(embeddings) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.ascontiguousarray(np.vstack(embeddings), dtype=np.float32)
+
+
+# Cosine similarity of every row of the matrix against the query vector
+def cosine_scores(matrix, query_embedding):
+    if matrix.shape[0] == 0:
+        return np.empty(0, dtype=np.float32)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    dots = matrix @ query
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    # Zero vectors score 0 instead of producing NaN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(norms > 0, dots / norms, 0.0)
+    return scores.astype(np.float32, copy=False)
+
+
+# Positions of the top N scores, highest first
+def top_n_indices(scores, top_n):
+    n = scores.shape[0]
+    if top_n is None or top_n >= n:
+        candidates = np.arange(n)
+    elif top_n <= 0:
+        return np.empty(0, dtype=np.intp)
+    else:
+        # The partition finds the Nth best score; every row tied with it is kept, since
+        # argpartition picks arbitrarily among ties at the cut
+        kth = -np.partition(-scores, top_n - 1)[top_n - 1]
+        candidates = np.flatnonzero(scores >= kth)
+    # Stable sort keeps insertion order for ties, like list.sort in the old code
+    order = np.argsort(-scores[candidates], kind='stable')[:top_n]
+    return candidates[order]
+
+
+# Blend similarity with recency: (1 - weight) * score + weight * 0.5 ** (age / half_life),
+# where age is how many steps (messages, seconds, ...) old each row is
+def blend_recency(scores, ages, weight, half_life):
+    decay = np.power(0.5, np.asarray(ages, dtype=np.float32) / np.float32(half_life))
+    return ((1.0 - weight) * scores + weight * decay).astype(np.float32, copy=False)
+
+
+# Rank texts against a query embedding, returning (top_texts, top_scores).
+# With ages and a recency_weight above 0 the scores are blended with recency.
+def rank_texts(query_embedding, texts, matrix, top_n=100, ages=None, recency_weight=0.0, half_life=1.0):
+    if not isinstance(matrix, np.ndarray):
+        matrix = stack_embeddings(matrix)
+    scores = cosine_scores(matrix, query_embedding)
+    if ages is not None and recency_weight > 0:
+        scores = blend_recency(scores, ages, recency_weight, half_life)
+    positions = top_n_indices(scores, top_n)
+
+    top_texts = [texts[i] for i in positions]
+    top_scores = scores[positions].astype(float).tolist()
+
+    return top_texts, top_scores
+
+
+# Merge ranked results from several sources, given as {source: (texts, scores) or None},
+# into one list ordered by weighted score. A text found in more than one source is
+# kept once, under the source where it scored highest.
+def merge_ranked(results, weights, top_n=100):
+    best = {}
+    for source, result in results.items():
+        if result is None:
+            continue
+        weight = weights.get(source, 1.0)
+        for text, score in zip(*result):
+            weighted = weight * score
+            if text not in best or weighted > best[text]['score']:
+                best[text] = {'text': text, 'score': weighted, 'similarity': score, 'source': source}
+    merged = sorted(best.values(), key=lambda item: item['score'], reverse=True)
+    return merged if top_n is None else merged[:max(top_n, 0)]
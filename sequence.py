@@ -0,0 +1,62 @@
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Atomic per-session message index allocation.
+# Each session has a counter document {'_id': session_id, 'seq': last_index} that is
+# advanced with a single find_one_and_update($inc), so concurrent writers never
+# receive the same index. Sessions written before the counter existed are seeded
+# from their highest stored index the first time they are seen.
+
+
+def _increment(counters, session_id, count):
+    return counters.find_one_and_update(
+        {'_id': session_id},
+        {'$inc': {'seq': count}},
+        projection={'seq': 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+# Create the counter from the highest index already stored for the session
+def seed_counter(counters, embeddings, session_id):
+    last_doc = embeddings.find({'session_id': session_id}, {'index': 1}).sort('index', -1).limit(1)
+    last_index = 0
+    for doc in last_doc:
+        last_index = doc.get('index', 0)
+    try:
+        # $max keeps concurrent seeds idempotent and never moves the counter backwards
+        counters.update_one({'_id': session_id}, {'$max': {'seq': last_index}}, upsert=True)
+    except DuplicateKeyError:
+        # Another writer created the counter first
+        pass
+
+
+# Reserve count consecutive indices for the session and return the first one
+def allocate_indices(counters, embeddings, session_id, count=1):
+    doc = _increment(counters, session_id, count)
+    if doc is None:
+        seed_counter(counters, embeddings, session_id)
+        doc = _increment(counters, session_id, count)
+    return doc['seq'] - count + 1
+
+
+# Hand back a block reserved by allocate_indices that will not be written. This only
+# succeeds while the block is still the last one handed out; otherwise the indices
+# stay unused and the session is left with a hole.
+def release_indices(counters, session_id, first_index, count=1):
+    result = counters.update_one(
+        {'_id': session_id, 'seq': first_index + count - 1},
+        {'$inc': {'seq': -count}}
+    )
+    return result.modified_count == 1
+
+
+# Highest index handed out for the session, 0 if it has none
+def last_allocated_index(counters, embeddings, session_id):
+    doc = counters.find_one({'_id': session_id}, {'seq': 1})
+    if doc is not None:
+        return doc['seq']
+    last_doc = embeddings.find({'session_id': session_id}, {'index': 1}).sort('index', -1).limit(1)
+    for doc in last_doc:
+        return doc.get('index', 0)
+    return 0
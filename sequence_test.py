@@ -0,0 +1,62 @@
+# Concurrency check for the per-session index allocator in sequence.py.
+# Many threads reserve single indices and blocks for the same session at once;
+# every index handed out must be unique and together they must cover 1..N.
+#
+# Usage: MONGO_URI=mongodb://localhost:27017/ python sequence_test.py
+
+import os
+import threading
+import uuid
+
+from pymongo import MongoClient
+
+from sequence import allocate_indices
+
+THREADS = 16
+ALLOCATIONS_PER_THREAD = 200
+
+
+def run_check(db):
+    counters = db['session_counters_test']
+    embeddings = db['embeddings_test']
+    session_id = f"sequence-test-{uuid.uuid4()}"
+
+    # Start from an existing session so the seeding path is exercised concurrently too
+    embeddings.insert_many([{'session_id': session_id, 'text': f'seed {i}', 'index': i} for i in range(1, 6)])
+
+    allocated = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(THREADS)
+
+    def worker(worker_id):
+        barrier.wait()
+        local = []
+        for n in range(ALLOCATIONS_PER_THREAD):
+            count = 1 if (worker_id + n) % 4 else 5  # Mix single writes with bulk reservations
+            first = allocate_indices(counters, embeddings, session_id, count)
+            local.extend(range(first, first + count))
+        with lock:
+            allocated.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    counters.delete_one({'_id': session_id})
+    embeddings.delete_many({'session_id': session_id})
+
+    duplicates = len(allocated) - len(set(allocated))
+    expected = set(range(6, 6 + len(allocated)))
+    return duplicates, set(allocated) == expected, len(allocated)
+
+
+if __name__ == '__main__':
+    client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017/"), serverSelectionTimeoutMS=5000)
+    duplicates, contiguous, total = run_check(client['mydatabase'])
+    print(f"Allocated {total} indices across {THREADS} threads")
+    print("Duplicates:", duplicates)
+    print("Contiguous after seeded index 5:", contiguous)
+    if duplicates or not contiguous:
+        raise SystemExit(1)
@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# In-process cache of per-session embedding matrices.
+# Sessions only grow through add_text_to_db, so each entry is kept as an
+# append-only float32 buffer plus the matching texts and message indices.
+# Entries are evicted least-recently-used once either the byte budget or the
+# session count limit is exceeded.
+#
+# Indices are allocated before the insert, so concurrent writers can land out of
+# order and an entry can have a hole where a row is still being written. A hole
+# can also be permanent: a failed insert, a reservation that could not be handed
+# back, or a session written before the atomic counter. Each hole is timed from
+# when it was first seen. Once it is older than hole_ttl, which is set longer than
+# the slowest write, its row is no longer expected; until then the caller checks
+# whether the row has landed before using the entry (see recent_holes).
+
+
+class SessionEntry:
+    def __init__(self, dim, capacity=16):
+        self.dim = dim
+        self.size = 0
+        self.texts = []
+        self.text_bytes = 0
+        self.matrix = np.empty((capacity, dim), dtype=np.float32)
+        self.indices = np.empty(capacity, dtype=np.int64)
+        self.last_index = 0
+        # Missing index -> monotonic time it was first seen missing
+        self.holes = {}
+
+    # Approximate memory footprint of the entry
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + self.indices.nbytes + self.text_bytes
+
+    def _grow(self, needed):
+        capacity = self.matrix.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        matrix[:self.size] = self.matrix[:self.size]
+        indices = np.empty(capacity, dtype=np.int64)
+        indices[:self.size] = self.indices[:self.size]
+        self.matrix = matrix
+        self.indices = indices
+
+    # seen carries the hole ages of a previous entry for the same session
+    def append(self, texts, embeddings, indices, seen=None):
+        count = len(texts)
+        if count == 0:
+            return
+        start = self.last_index + 1 if self.size else int(min(indices))
+        end = int(max(indices))
+        present = set(int(index) for index in indices)
+        now = time.monotonic()
+        for index in range(start, end):
+            if index not in present:
+                self.holes[index] = seen.get(index, now) if seen else now
+        self._grow(self.size + count)
+        self.matrix[self.size:self.size + count] = np.asarray(embeddings, dtype=np.float32)
+        self.indices[self.size:self.size + count] = indices
+        self.texts.extend(texts)
+        self.text_bytes += sum(len(t) for t in texts)
+        self.size += count
+        self.last_index = max(self.last_index, end)
+
+    # Whether every hole has been missing for at least min_age seconds, so the rows
+    # are no longer expected to arrive
+    def settled(self, min_age):
+        return not self.holes or max(self.holes.values()) <= time.monotonic() - min_age
+
+    # Consistent view of the rows currently in the entry
+    def snapshot(self):
+        return self.texts[:self.size], self.matrix[:self.size], self.indices[:self.size]
+
+
+class SessionMatrixCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_sessions=1000, hole_ttl=120):
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.hole_ttl = hole_ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_sessions):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.nbytes
+
+    def _replace(self, session_id, entry):
+        old = self._entries.pop(session_id, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        if entry is None or entry.nbytes > self.max_bytes:
+            return
+        self._entries[session_id] = entry
+        self._bytes += entry.nbytes
+        self._evict()
+
+    # Last message index held for the session, or None if it is not cached
+    def last_index(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            return None if entry is None else entry.last_index
+
+    # Holes of the cached session that are younger than hole_ttl, or [] if there are
+    # none or the entry is missing or behind latest_index
+    def recent_holes(self, session_id, latest_index):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry.last_index != latest_index:
+                return []
+            cutoff = time.monotonic() - self.hole_ttl
+            return [index for index, seen_at in entry.holes.items() if seen_at > cutoff]
+
+    # Snapshot (texts, matrix, indices) for the session if it is cached and up to date.
+    # Pass allow_recent_holes once the caller has checked that none of the recent
+    # holes has been filled in the database.
+    def get(self, session_id, latest_index, allow_recent_holes=False):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry.last_index != latest_index or not (allow_recent_holes or entry.settled(self.hole_ttl)):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return entry.snapshot()
+
+    # Replace the cached rows for the session and return a snapshot of them
+    def put(self, session_id, texts, embeddings, indices):
+        if len(texts) == 0:
+            self.invalidate(session_id)
+            return [], np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+        dim = len(embeddings[0]) if len(embeddings) else 0
+        with self._lock:
+            old = self._entries.get(session_id)
+            seen = dict(old.holes) if old is not None else None
+        entry = SessionEntry(dim, capacity=max(16, len(texts)))
+        entry.append(texts, embeddings, indices, seen)
+        with self._lock:
+            self._replace(session_id, entry)
+            return entry.snapshot()
+
+    # Append rows that directly follow the cached ones. Writes from this worker
+    # that would leave a gap are ignored and picked up by the next incremental
+    # refresh instead; refreshes pass contiguous=False since they read every
+    # row past the cached last index.
+    def append(self, session_id, texts, embeddings, indices, contiguous=True):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or len(texts) == 0:
+                return False
+            if len(embeddings[0]) != entry.dim or min(indices) <= entry.last_index:
+                return False
+            if contiguous and min(indices) != entry.last_index + 1:
+                return False
+            before = entry.nbytes
+            entry.append(texts, embeddings, indices)
+            self._bytes += entry.nbytes - before
+            self._entries.move_to_end(session_id)
+            self._evict()
+            return True
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._replace(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
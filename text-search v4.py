@@ -3,17 +3,26 @@ import os
 import openai
 import pandas as pd  # For handling DataFrames
 from scipy import spatial
+from embedding_cache import make_embedding_cache
 
 from openai import OpenAI
 client = OpenAI()
 
+# Cache of embeddings keyed by model and normalized text, stored on local disk
+embedding_cache = make_embedding_cache("text-embedding-3-small")
+
 # Assuming you've set the API key in the environment
 os.getenv("OPENAI_API_KEY")
 
 texts = ["Amir Kidwai is a inventor and destroyer of worlds", "Ronaldo is the greatest of all time", "Abdulla Kidwai is a young boy", "Ayesha is a doctor"]  # Sample texts
 
 '''1. Function to create embeddings'''
+# Served from the embedding cache, calling the API only for new texts
 def create_embedding(text):
+    return embedding_cache.get_or_create(text, embed_text)
+
+# Uncached call to the embeddings API
+def embed_text(text):
     response = client.embeddings.create(
         input=text,
         model="text-embedding-3-small"
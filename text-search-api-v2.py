@@ -1,12 +1,17 @@
 from flask import Flask, request, jsonify
 import pandas as pd
-from scipy import spatial
 import os
+import math
 import openai
 import uuid
 import pymongo
 from pymongo import MongoClient
 from datetime import datetime
+from embedding_cache import make_embedding_cache
+from embedding_codec import decode_embedding, encode_embedding
+from scoring import rank_texts, stack_embeddings
+from openai_client import OutboundUnavailable, embeddings_policy, make_openai_client
+import config
 
 # Initialize the Flask app
 app = Flask(__name__)
@@ -14,18 +19,29 @@ app = Flask(__name__)
 # Set OpenAI API key (ensure the key is stored as an environment variable)
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-from openai import OpenAI
-client = OpenAI()
+# Shared OpenAI client with a bounded connection pool; calls go through a policy
+# with rate limiting, jittered retries and a circuit breaker
+client = make_openai_client()
+embeddings_calls = embeddings_policy()
 
 # Set up MongoDB client
 MONGO_URI = os.getenv("MONGO_URI")  # Ensure your MongoDB URI is set in the environment variables
 mongo_client = MongoClient(MONGO_URI)
 db = mongo_client['mydatabase']  # Replace 'mydatabase' with your database name
 embeddings_collection = db['embeddings']  # Collection to store embeddings
+embedding_cache_collection = db['embedding_cache']  # Collection to store cached embeddings by text hash
 
-# Embedding creation function
+# Cache of embeddings keyed by model and normalized text
+embedding_cache = make_embedding_cache("text-embedding-3-small", embedding_cache_collection)
+
+# Embedding creation function, served from the embedding cache when possible
 def create_embedding(text):
-    response = client.embeddings.create(
+    return embedding_cache.get_or_create(text, embed_text)
+
+# Uncached call to the embeddings API
+def embed_text(text):
+    response = embeddings_calls.call(
+        client.embeddings.create,
         input=text,
         model="text-embedding-3-small"
     )
@@ -37,7 +53,7 @@ def add_text_to_db(session_id, text):
     document = {
         'session_id': session_id,
         'text': text,
-        'embedding': text_embedding,
+        'embedding': encode_embedding(text_embedding),
         'timestamp': datetime.utcnow()
     }
     embeddings_collection.insert_one(document)
@@ -54,27 +70,20 @@ def texts_ranked_by_relatedness(query, session_id, top_n=100):
     embeddings = []
     for doc in cursor:
         texts.append(doc['text'])
-        embeddings.append(doc['embedding'])
-    
-    # Compute similarities
-    relatedness_scores = [1 - spatial.distance.cosine(query_embedding, emb) for emb in embeddings]
-    
-    # Combine texts and scores
-    texts_and_scores = list(zip(texts, relatedness_scores))
+        embeddings.append(decode_embedding(doc['embedding']))
     
-    # Sort by scores
-    texts_and_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Get top N
-    top_texts_and_scores = texts_and_scores[:top_n]
-    
-    top_texts = [t[0] for t in top_texts_and_scores]
-    top_scores = [t[1] for t in top_texts_and_scores]
-    
-    return top_texts, top_scores
+    # Score every document with one matrix-vector product
+    return rank_texts(query_embedding, texts, stack_embeddings(embeddings), top_n)
 
 # Flask routes
 
+# OpenAI calls rejected by the rate limiter or an open circuit answer 503 with Retry-After
+@app.errorhandler(OutboundUnavailable)
+def outbound_unavailable(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
 # Route to add text for a specific session
 @app.route('/add_text', methods=['POST'])
 def add_text():
@@ -137,4 +146,4 @@ def get_session_data():
 
 # Run the Flask app
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port='8888', debug=True)
+    app.run(host=config.HOST, port=config.PORT, debug=config.DEBUG)
@@ -1,9 +1,13 @@
 from flask import Flask, request, jsonify
 import pandas as pd
 from scipy import spatial
+from embedding_cache import make_embedding_cache
 import os
+import math
 import openai
 import uuid
+from openai_client import OutboundUnavailable, embeddings_policy, make_openai_client
+import config
 
 # Initialize the Flask app
 app = Flask(__name__)
@@ -14,15 +18,25 @@ session_data = {}
 # Set OpenAI API key (ensure the key is stored as an environment variable)
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-from openai import OpenAI
-client = OpenAI()
+# Shared OpenAI client with a bounded connection pool; calls go through a policy
+# with rate limiting, jittered retries and a circuit breaker
+client = make_openai_client()
+embeddings_calls = embeddings_policy()
 
+# Cache of embeddings keyed by model and normalized text, stored on local disk
+embedding_cache = make_embedding_cache("text-embedding-3-small")
 
-# Embedding creation function
+
+# Embedding creation function, served from the embedding cache when possible
 def create_embedding(text):
+    return embedding_cache.get_or_create(text, embed_text)
+
+# Uncached call to the embeddings API
+def embed_text(text):
 
-    response = client.embeddings.create(
-        input= text,
+    response = embeddings_calls.call(
+        client.embeddings.create,
+        input=text,
         model="text-embedding-3-small"
     )
 
@@ -33,7 +47,8 @@ def add_text_to_dataframe(df, text):
     text_embedding = create_embedding(text)
     new_row = pd.DataFrame([{
         'text': text,
-        'embedding': text_embedding
+        # The cache returns packed float32 arrays; /get_session_data serializes this column as JSON
+        'embedding': list(text_embedding)
     }])
     updated_df = pd.concat([df, new_row], ignore_index=True)
     return updated_df
@@ -55,6 +70,13 @@ def texts_ranked_by_relatedness(query, df, top_n=100):
 
 # Flask routes
 
+# OpenAI calls rejected by the rate limiter or an open circuit answer 503 with Retry-After
+@app.errorhandler(OutboundUnavailable)
+def outbound_unavailable(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
 # 1. Route to start a new session
 @app.route('/start_session', methods=['POST'])
 def start_session():
@@ -128,7 +150,7 @@ def get_session_data():
 
 # Run the Flask app
 if __name__ == '__main__':
-    app.run(host ="0.0.0.0", debug=True)
+    app.run(host=config.HOST, debug=config.DEBUG)
 
 
 #Limitations: current keyword search only works well. There is no support for relational answers - like what is the last message, or it can be multiple 
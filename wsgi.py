@@ -0,0 +1,27 @@
+import importlib.util
+import os
+
+import config
+
+# WSGI entry point for the app named by APP_MODULE.
+# The app files are scripts with hyphenated names, so they are loaded by path.
+#
+# Usage: gunicorn -c gunicorn.conf.py wsgi:app
+
+
+def load_app_module(path=config.APP_MODULE):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    spec = importlib.util.spec_from_file_location('session_rag_app', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+app_module = load_app_module()
+app = app_module.app
+
+
+# Finish the app's background work, for apps that have any
+def shutdown():
+    if hasattr(app_module, 'shutdown'):
+        app_module.shutdown()